@@ -0,0 +1,87 @@
+'''Check that frost commands which do not touch netcdf files start quickly.
+Each command is run with python -X importtime, and the script fails if the
+imports for any of them take longer than the budget, or load any of the
+modules only needed for writing files.
+
+Usage: python benchmarks/bench_import_time.py [--budget MILLISECONDS] [--repeat N]
+'''
+import argparse
+import os
+import subprocess
+import sys
+
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that should only be loaded by commands that write or read files
+heavy_modules = ['numpy', 'netCDF4', 'cf_units', 'jinja2', 'yaml']
+
+commands = [
+    ['--help'],
+    ['download', '--help'],
+    ['download', 'source', '--help'],
+    ['download', 'elements', '--help'],
+    ['download', 'observations', '--help'],
+    ['sync', '--help'],
+]
+
+# Run the command line program after a marker, so that imports done by
+# python itself at startup can be told apart
+program = '''
+import sys
+sys.stderr.write('-- start\\n')
+sys.argv = ['frost'] + sys.argv[1:]
+from frost_extract.__main__ import cli
+cli()
+'''
+
+
+def measure(args):
+    '''Run frost with the given arguments, returning the microseconds spent
+    importing, and the names of all imported modules'''
+    env = dict(os.environ, PYTHONPATH=repository)
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', program] + args,
+                             env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    lines = process.stderr.splitlines()
+    lines = lines[lines.index('-- start') + 1:]
+    total = 0
+    modules = set()
+    for line in lines:
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if not fields[1].strip().isdigit():
+            # The header line
+            continue
+        name = fields[2]
+        modules.add(name.strip())
+        # Top level imports have a single space before the name, and their
+        # cumulative time includes everything they import
+        if len(name) - len(name.lstrip()) == 1:
+            total += int(fields[1])
+    return total, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--budget', type=float, default=150, help='Maximum milliseconds of imports for each command')
+    parser.add_argument('--repeat', type=int, default=5, help='Run each command this many times, keeping the fastest')
+    args = parser.parse_args()
+
+    failed = []
+    print('%-36s %10s  %s' % ('command', 'import ms', 'heavy modules'))
+    for command in commands:
+        results = [measure(command) for _ in range(args.repeat)]
+        milliseconds = min(total for total, modules in results) / 1000
+        heavy = sorted(m for m in heavy_modules if any(m in modules for total, modules in results))
+        name = 'frost ' + ' '.join(command)
+        print('%-36s %10.1f  %s' % (name, milliseconds, ', '.join(heavy) or '-'))
+        if milliseconds > args.budget or heavy:
+            failed.append(name)
+
+    if failed:
+        print('Over budget: ' + ', '.join(failed))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
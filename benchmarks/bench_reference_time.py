@@ -0,0 +1,31 @@
+'''Compare referenceTime parsing with dateutil against the batched parser
+used by NetcdfWriter.add_observations.
+
+Usage: python benchmarks/bench_reference_time.py [number of time steps]
+'''
+import dateutil.parser
+from datetime import datetime, timedelta, timezone
+from frost_extract.times import parse_reference_times
+import sys
+import timeit
+
+
+def main(count):
+    start = datetime(1990, 1, 1)
+    reference_times = [(start + timedelta(hours=i)).strftime('%Y-%m-%dT%H:%M:%S.000Z') for i in range(count)]
+    epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+    def with_dateutil():
+        return [(dateutil.parser.parse(t) - epoch).total_seconds() for t in reference_times]
+
+    def batched():
+        return parse_reference_times(reference_times)
+
+    assert list(batched()) == with_dateutil()
+    for name, f in (('dateutil', with_dateutil), ('batched', batched)):
+        seconds = min(timeit.repeat(f, number=1, repeat=3))
+        print('%-10s %8.4f s  %12.0f times/s' % (name, seconds, count / seconds))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,68 @@
+'''Measure write, append and read throughput of each netcdf storage profile,
+using synthetic hourly station data.
+
+Usage: python benchmarks/bench_storage_profiles.py [--years N] [--appends N]
+'''
+import argparse
+from datetime import datetime, timedelta
+from frost_extract.write_netcdf import NetcdfWriter, storage_profiles
+import netCDF4
+import os
+from synthetic import SyntheticFrost, elements
+import tempfile
+import time
+
+element_ids = ['air_temperature', 'relative_humidity', 'wind_speed', 'air_pressure_at_sea_level']
+
+
+def write(file_name, profile, source, data, append):
+    writer = NetcdfWriter(profile)
+    writer.add_observation_data(data)
+    start = time.perf_counter()
+    writer.write_to(file_name, dict(source), elements, append)
+    return time.perf_counter() - start
+
+
+def read(file_name):
+    start = time.perf_counter()
+    with netCDF4.Dataset(file_name) as nc:
+        count = 0
+        for name, var in nc.variables.items():
+            if var.dimensions == ('time',):
+                count += var[:].size
+    return time.perf_counter() - start, count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--years', type=int, default=10, help='Years of hourly data in the initial file')
+    parser.add_argument('--appends', type=int, default=48, help='Number of hourly appends after the initial write')
+    args = parser.parse_args()
+
+    end = datetime(2000, 1, 1) + timedelta(days=round(args.years * 365.25))
+    frost = SyntheticFrost(1, args.years, element_ids, end=end + timedelta(hours=args.appends))
+    station = frost.stations[0]
+    source = frost.get_source(station)
+    data = frost.get_observations([station], element_ids, frost.start, end)
+    appended = [frost.get_observations([station], element_ids, end + timedelta(hours=i), end + timedelta(hours=i + 1)) for i in range(args.appends)]
+    values = len(data) * len(element_ids)
+
+    folder = tempfile.mkdtemp()
+    print('%-18s %12s %12s %12s %10s' % ('profile', 'write/s', 'appends/s', 'read/s', 'size MB'))
+    for profile in storage_profiles:
+        file_name = os.path.join(folder, profile + '.nc')
+        write_seconds = write(file_name, profile, source, data, False)
+        append_seconds = sum(write(file_name, profile, source, d, True) for d in appended)
+        read_seconds, count = read(file_name)
+        print('%-18s %12.0f %12.1f %12.0f %10.2f' % (
+            profile,
+            values / write_seconds,
+            len(appended) / append_seconds if appended else 0,
+            count / read_seconds,
+            os.path.getsize(file_name) / 1e6))
+        os.remove(file_name)
+    os.rmdir(folder)
+
+
+if __name__ == '__main__':
+    main()
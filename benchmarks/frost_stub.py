@@ -0,0 +1,151 @@
+'''A local http server imitating the parts of the frost api used by
+frost_extract, serving synthetic data. Responses may be delayed, and a share
+of them may be replaced by 429 or 500 errors, to see how clients cope.
+
+Usage: python benchmarks/frost_stub.py [--port N] [--stations N] [--years N] [--latency SECONDS] [--error-rate FRACTION]
+'''
+import argparse
+from datetime import datetime
+import gzip
+import http.server
+import json
+import random
+from synthetic import SyntheticFrost, resolutions
+import threading
+import time
+import urllib.parse
+
+
+class FrostStub(object):
+    '''Serves data from a SyntheticFrost on localhost. latency is added to
+    every request, and error_rate is the share of requests that get one of
+    error_codes instead of data. 429 responses have a Retry-After header.'''
+
+    def __init__(self, frost, port=0, latency=0.0, error_rate=0.0, error_codes=(429, 500), seed=1):
+        self.frost = frost
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_codes = error_codes
+        self.requests = 0
+        self.errors = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', port), _make_handler(self))
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _next_error(self):
+        '''Count a request, and get the error code to reply with, if any'''
+        with self._lock:
+            self.requests += 1
+            if self.error_rate and self._random.random() < self.error_rate:
+                self.errors += 1
+                return self._random.choice(self.error_codes)
+        return None
+
+    def respond(self, path, query):
+        '''Get (status, data) for a request'''
+        if self.latency:
+            time.sleep(self.latency)
+        error = self._next_error()
+        if error:
+            return error, None
+
+        query = dict(urllib.parse.parse_qsl(query))
+        service = path[1:].rsplit('/', 1)[0]
+        if service == 'elements':
+            data = self.frost.get_elements()
+        elif service == 'sources':
+            ids = query.get('ids')
+            stations = ids.split(',') if ids else self.frost.stations
+            data = [self.frost.get_source(s) for s in stations if s in self.frost.stations]
+        elif service == 'observations/availableTimeSeries':
+            data = self.frost.get_available(_split(query.get('sources')), _split(query.get('elements')))
+        elif service == 'observations':
+            time_from, time_to = [_parse_time(t) for t in query['referencetime'].split('/')]
+            data = self.frost.get_observations(_split(query.get('sources')), _split(query.get('elements')), time_from, time_to)
+        else:
+            return 404, None
+        if not data:
+            return 404, None
+        return 200, data
+
+
+def _split(value):
+    return value.split(',') if value else []
+
+
+def _parse_time(t):
+    return datetime.strptime(t[:19], '%Y-%m-%dT%H:%M:%S')
+
+
+def _make_handler(stub):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            url = urllib.parse.urlsplit(self.path)
+            status, data = stub.respond(url.path, url.query)
+            if data is None:
+                body = json.dumps({'error': {'code': status}}).encode('utf8')
+            else:
+                body = json.dumps({'@context': 'https://frost.met.no/schema', 'data': data}).encode('utf8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            if status == 429:
+                self.send_header('Retry-After', '1')
+            if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                body = gzip.compress(body, 1)
+                self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on')
+    parser.add_argument('--stations', type=int, default=1, help='Number of stations, named SN90000 and up')
+    parser.add_argument('--years', type=float, default=1, help='Years of data for each station')
+    parser.add_argument('--resolution', default='PT1H', choices=list(resolutions), help='Time between observations')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds to wait before answering a request')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of requests to answer with 429 or 500')
+    args = parser.parse_args()
+
+    stub = FrostStub(SyntheticFrost(args.stations, args.years, resolution=args.resolution), args.port, args.latency, args.error_rate)
+    print('Serving %s on %s' % (', '.join(stub.frost.stations), stub.url))
+    with stub:
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
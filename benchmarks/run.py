@@ -0,0 +1,160 @@
+'''Run frost_extract end to end against a local frost stub, timing download
+observations, write netcdf (create and append) and write mmd. Results may be
+saved, and compared against results saved earlier.
+
+Usage: python benchmarks/run.py [--stations N] [--years N] [--output results.json] [--baseline old.json]
+'''
+import argparse
+import json
+import math
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Use the same frost_extract as the frost commands run below
+sys.path.insert(0, repository)
+
+from frost_extract.read_frost import find_month_files
+from frost_stub import FrostStub
+from synthetic import SyntheticFrost, elements, resolutions
+
+steps = ['download observations', 'write netcdf', 'write netcdf --append', 'write mmd']
+
+
+def frost(env, *args):
+    '''Run the frost command line program, returning its output and the
+    time it took'''
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, '-m', 'frost_extract'] + list(args), env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    seconds = time.perf_counter() - start
+    if process.returncode != 0:
+        raise RuntimeError('frost %s failed:\n%s' % (' '.join(args), process.stderr))
+    return process.stdout, seconds
+
+
+def run(args, stub, folder):
+    '''Run each step once, returning the seconds each of them took'''
+    env = dict(os.environ, FROST_SERVER=stub.url, FROST_KEY='benchmark', PYTHONPATH=repository)
+    stations = stub.frost.stations
+    archive = os.path.join(folder, 'archive')
+    output = os.path.join(folder, 'output')
+    mmd = os.path.join(folder, 'mmd')
+    for f in (archive, output, mmd):
+        os.makedirs(f)
+    ret = {}
+
+    out, _ = frost(env, 'download', 'elements')
+    elements_file = os.path.join(archive, 'elements.json')
+    with open(elements_file, 'w') as f:
+        f.write(out)
+    for station in stations:
+        out, _ = frost(env, 'download', 'source', '-s', station)
+        with open(os.path.join(archive, station + '.json'), 'w') as f:
+            f.write(out)
+
+    download = ['download', 'observations', '-o', archive, '--duration', str(math.ceil(args.years * 12) + 1),
+                '--concurrency', str(args.concurrency), '--batch-size', str(args.batch_size), '--format', args.format]
+    for e in stub.frost.element_ids:
+        download += ['-e', e]
+    for station in stations:
+        download += ['-s', station]
+    _, ret['download observations'] = frost(env, *download)
+
+    # The latest month is kept back, to be appended afterwards
+    ret['write netcdf'] = 0
+    ret['write netcdf --append'] = 0
+    nc_files = []
+    for station in stations:
+        month_files = find_month_files(os.path.join(archive, station), args.format)
+        nc_file = os.path.join(output, station + '.nc')
+        common = ['write', 'netcdf', '-o', nc_file, '-s', os.path.join(archive, station + '.json'), '-e', elements_file, '--profile', args.profile]
+        _, seconds = frost(env, *(common + month_files[:-1]))
+        ret['write netcdf'] += seconds
+        _, seconds = frost(env, *(common + ['--append'] + month_files[-1:]))
+        ret['write netcdf --append'] += seconds
+        nc_files.append(nc_file)
+
+    _, ret['write mmd'] = frost(env, 'write', 'mmd', '-o', mmd, '-l', 'https://example.com/opendap', *nc_files)
+    return ret
+
+
+def compare(results, baseline, tolerance):
+    '''Print a comparison with the baseline, returning the steps that are
+    slower than the baseline by more than tolerance'''
+    if results['config'] != baseline['config']:
+        print('Warning: baseline was run with a different configuration: %s' % (json.dumps(baseline['config']),))
+    slower = []
+    print('%-24s %10s %10s %8s' % ('step', 'baseline', 'now', 'change'))
+    for step in steps:
+        old = baseline['seconds'].get(step)
+        new = results['seconds'][step]
+        if not old:
+            print('%-24s %10s %10.3f' % (step, '-', new))
+            continue
+        change = new / old - 1
+        print('%-24s %10.3f %10.3f %+7.0f%%' % (step, old, new, change * 100))
+        if change > tolerance:
+            slower.append(step)
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--stations', type=int, default=3, help='Number of stations')
+    parser.add_argument('--years', type=float, default=2, help='Years of data for each station')
+    parser.add_argument('--element', '-e', dest='elements', action='append', choices=list(elements), help='Elements to use. May be given several times. Default is all of them')
+    parser.add_argument('--resolution', default='PT1H', choices=list(resolutions), help='Time between observations')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds the stub waits before answering a request')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of requests the stub answers with 429 or 500')
+    parser.add_argument('--concurrency', type=int, default=1, help='--concurrency for download observations')
+    parser.add_argument('--batch-size', type=int, default=1, help='--batch-size for download observations')
+    parser.add_argument('--format', default='json', choices=['json', 'npz'], help='--format for download observations')
+    parser.add_argument('--profile', default='default', help='--profile for write netcdf')
+    parser.add_argument('--repeat', type=int, default=3, help='Run everything this many times, keeping the best time for each step')
+    parser.add_argument('--output', '-o', help='Save results to this file')
+    parser.add_argument('--baseline', '-b', help='Compare with results saved earlier in this file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='With --baseline, fail if any step is slower by more than this fraction')
+    args = parser.parse_args()
+
+    config = {k: v for k, v in vars(args).items() if k not in ('repeat', 'output', 'baseline', 'tolerance')}
+    seconds = {}
+    with FrostStub(SyntheticFrost(args.stations, args.years, args.elements, args.resolution), latency=args.latency, error_rate=args.error_rate) as stub:
+        for _ in range(args.repeat):
+            folder = tempfile.mkdtemp()
+            try:
+                for step, s in run(args, stub, folder).items():
+                    seconds[step] = min(s, seconds.get(step, s))
+            finally:
+                shutil.rmtree(folder)
+        requests, errors = stub.requests, stub.errors
+
+    results = {
+        'config': config,
+        'python': platform.python_version(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'requests': requests // args.repeat,
+        'errors': errors // args.repeat,
+        'seconds': seconds,
+    }
+    for step in steps:
+        print('%-24s %10.3f' % (step, seconds[step]))
+    print('%d requests, %d errors per run' % (results['requests'], results['errors']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = compare(results, json.load(f), args.tolerance)
+        if slower:
+            print('Slower than baseline: ' + ', '.join(slower))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
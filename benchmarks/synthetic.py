@@ -0,0 +1,116 @@
+'''Synthetic frost data for benchmarks. Generates elements, sources,
+available time series and observations in the same json layout as the
+frost api, for any number of stations, years, elements and time resolution.
+'''
+from datetime import datetime, timedelta
+import math
+
+elements = {
+    'air_temperature': {'id': 'air_temperature', 'name': 'Air temperature', 'unit': 'degC',
+                        'cfConvention': {'standardName': 'air_temperature', 'unit': 'K'}},
+    'relative_humidity': {'id': 'relative_humidity', 'name': 'Relative humidity', 'unit': 'percent',
+                          'cfConvention': {'standardName': 'relative_humidity', 'unit': 'percent'}},
+    'wind_speed': {'id': 'wind_speed', 'name': 'Wind speed', 'unit': 'm/s',
+                   'cfConvention': {'standardName': 'wind_speed', 'unit': 'm/s'}},
+    'wind_from_direction': {'id': 'wind_from_direction', 'name': 'Wind direction', 'unit': 'degrees',
+                            'cfConvention': {'standardName': 'wind_from_direction', 'unit': 'degree'}},
+    'air_pressure_at_sea_level': {'id': 'air_pressure_at_sea_level', 'name': 'Air pressure', 'unit': 'hPa',
+                                  'cfConvention': {'standardName': 'air_pressure_at_sea_level', 'unit': 'Pa'}},
+    'surface_air_pressure': {'id': 'surface_air_pressure', 'name': 'Station pressure', 'unit': 'hPa',
+                             'cfConvention': {'standardName': 'surface_air_pressure', 'unit': 'Pa'}},
+}
+
+resolutions = {'PT10M': timedelta(minutes=10), 'PT1H': timedelta(hours=1), 'P1D': timedelta(days=1)}
+
+time_format = '%Y-%m-%dT%H:%M:%S.000Z'
+
+
+class SyntheticFrost(object):
+    '''Deterministic frost data set. Stations are named SN90000, SN90001,
+    and so on, and all have the given elements for the given number of years
+    up until end.'''
+
+    def __init__(self, stations=1, years=1, element_ids=None, resolution='PT1H', end=None):
+        if resolution not in resolutions:
+            raise RuntimeError('Unsupported resolution %s. Use one of %s' % (resolution, ', '.join(resolutions)))
+        self.stations = ['SN%d' % (90000 + i,) for i in range(stations)]
+        self.element_ids = list(element_ids or elements)
+        for e in self.element_ids:
+            if e not in elements:
+                raise RuntimeError('Unknown element %s. Use one of %s' % (e, ', '.join(elements)))
+        self.resolution = resolution
+        self.step = resolutions[resolution]
+        if end is None:
+            today = datetime.utcnow()
+            end = datetime(today.year, today.month, today.day, today.hour)
+        self.end = end
+        self.start = end - timedelta(days=round(years * 365.25))
+
+    def get_elements(self):
+        return [elements[e] for e in elements]
+
+    def get_source(self, station):
+        number = int(station[2:])
+        return {
+            'id': station,
+            'name': 'BENCHMARK %d' % (number,),
+            'wigosId': '0-578-0-%d' % (number,),
+            'wmoId': number,
+            'geometry': {'type': 'Point', 'coordinates': [10 + (number % 100) * 0.1, 59 + (number % 50) * 0.1]},
+        }
+
+    def get_available(self, stations, element_ids):
+        '''Available time series, as returned by observations/availableTimeSeries'''
+        ret = []
+        for station in stations:
+            if station not in self.stations:
+                continue
+            for e in element_ids:
+                if e in self.element_ids:
+                    ret.append({
+                        'sourceId': station + ':0',
+                        'elementId': e,
+                        'validFrom': self.start.strftime(time_format),
+                        'timeOffset': 'PT0H',
+                        'timeResolution': self.resolution,
+                    })
+        return ret
+
+    def get_observations(self, stations, element_ids, time_from, time_to):
+        '''Observations in [time_from, time_to), as returned by observations'''
+        element_ids = [e for e in element_ids if e in self.element_ids]
+        stations = [s for s in stations if s in self.stations]
+        ret = []
+        if not element_ids or not stations:
+            return ret
+        t = max(time_from, self.start)
+        # Align to the time resolution, the way frost does
+        t = self.start + math.ceil((t - self.start) / self.step) * self.step
+        end = min(time_to, self.end)
+        while t < end:
+            reference_time = t.strftime(time_format)
+            hours = (t - datetime(1970, 1, 1)).total_seconds() / 3600
+            for station in stations:
+                number = int(station[2:])
+                ret.append({
+                    'sourceId': station + ':0',
+                    'referenceTime': reference_time,
+                    'observations': [self._observation(e, hours, number, i) for i, e in enumerate(element_ids)],
+                })
+            t += self.step
+        return ret
+
+    def _observation(self, element_id, hours, number, index):
+        value = 10 + index * 5 + 8 * math.sin(hours * math.pi / 12 + number) + 3 * math.sin(hours * 0.37 + index)
+        return {
+            'elementId': element_id,
+            'value': round(value, 1),
+            'unit': elements[element_id]['unit'],
+            'level': {'levelType': 'height_above_ground', 'unit': 'm', 'value': 2},
+            'timeOffset': 'PT0H',
+            'timeResolution': self.resolution,
+            'timeSeriesId': 0,
+            'performanceCategory': 'C',
+            'exposureCategory': '2',
+            'qualityCode': 0,
+        }
@@ -1,9 +1,14 @@
 import click
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
 from dateutil.relativedelta import relativedelta
-import frost_extract.metadata
+# Modules needing netCDF4, cf_units or jinja2 are imported in the commands
+# using them, so that other commands start quickly
 import frost_extract.read_frost
-from frost_extract.write_netcdf import NetcdfWriter
+from frost_extract.catalogue import Catalogue
+from frost_extract.metrics import metrics
+from frost_extract.profiles import collection_layouts, storage_profiles
+from frost_extract.selection import SelectionRules
+from frost_extract.sync_state import SyncState
 import json
 import logging
 import os
@@ -11,20 +16,54 @@ import sys
 
 
 @click.group()
+@click.pass_context
 @click.option('--loglevel', type=click.Choice(['debug', 'info', 'warn', 'error', 'critical']), default='warn')
-def cli(loglevel):
+@click.option('--metrics', 'metrics_file', type=click.Path(dir_okay=False, writable=True), help='Write counters and per-stage timings for the run to this file when done. Written as a prometheus textfile if the name ends with .prom, and as json otherwise')
+@click.option('--cprofile', 'profile_file', type=click.Path(dir_okay=False, writable=True), help='Profile the run with cProfile, and write the statistics to this file. Inspect it with python -m pstats')
+def cli(ctx, loglevel, metrics_file, profile_file):
     '''Process observations from a frost server, possibly generating netcdf files and such from them.'''
     logging.getLogger().setLevel(loglevel.upper())
+    if profile_file:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        def dump_profile():
+            profiler.disable()
+            profiler.dump_stats(profile_file)
+        ctx.call_on_close(dump_profile)
+    if metrics_file:
+        def write_metrics():
+            summary = metrics.summary()
+            logging.info('Stage timings: ' + ', '.join('%s %.3fs' % s for s in sorted(summary['seconds'].items())))
+            metrics.write(metrics_file)
+        ctx.call_on_close(write_metrics)
 
 
 @click.group()
 @click.pass_context
-@click.option('--server', default='frost.met.no', envvar='FROST_SERVER', help='name of frost server to connect to')
+@click.option('--server', default='frost.met.no', envvar='FROST_SERVER', help='name of frost server to connect to, or its full url')
 @click.option('--key', prompt=True, hide_input=True, envvar='FROST_KEY', help='API key for frost')
-def download(ctx, server, key):
-    '''Download data from a frost server. Note that you may use environment variables FROST_SERVER and FROST_KEY for parameters here.'''
+@click.option('--rate', default=0, type=click.FloatRange(0), help='Maximum number of requests per second to send to frost, shared by all concurrent downloads. 0 means no limit')
+@click.option('--retries', default=5, type=click.IntRange(0), help='Number of times to retry requests that fail because of throttling, server errors or network problems')
+@click.option('--catalogue', 'catalogue_file', envvar='FROST_CATALOGUE', type=click.Path(dir_okay=False, writable=True), help='Cache frost elements and sources in this file, and only ask frost for them again when older than --catalogue-ttl. The file may also be given to write netcdf --elements')
+@click.option('--catalogue-ttl', default=24, type=click.FloatRange(0), help='Hours before cached elements and sources are refreshed. Unchanged data is not downloaded again, if frost supports it')
+def download(ctx, server, key, rate, retries, catalogue_file, catalogue_ttl):
+    '''Download data from a frost server. Note that you may use environment variables FROST_SERVER, FROST_KEY and FROST_CATALOGUE for parameters here.'''
     ctx.obj = {}
-    ctx.obj['frost'] = frost_extract.read_frost.FrostApi('https://' + server, key)
+    ctx.obj['frost'] = _frost_api(server, key, rate, retries, catalogue_file, catalogue_ttl)
+
+def _frost_api(server, key, rate, retries, catalogue_file=None, catalogue_ttl=24):
+    limiter = frost_extract.read_frost.RateLimiter(rate or None)
+    retry_policy = frost_extract.read_frost.RetryPolicy(retries + 1)
+    catalogue = None
+    if catalogue_file:
+        catalogue = Catalogue(catalogue_file, timedelta(hours=catalogue_ttl))
+    return frost_extract.read_frost.FrostApi(_server_url(server), key, limiter, retry_policy, catalogue)
+
+def _server_url(server):
+    if '://' in server:
+        return server
+    return 'https://' + server
 
 default_elements = [
     'air_temperature', 
@@ -44,14 +83,30 @@ default_elements = [
 @click.option('--station', '-s', 'stations', multiple=True, help='Stations to fetch data for. Use frost notation, such as SN18700. May be specified multiple times')
 @click.option('--until', '-t', help='Latest year and month to get data for. Use format YYYY-MM. Will be current month if not specified')
 @click.option('--duration', type=int, help='Duration back in time to get data for, in months')
-def observations(ctx, output_folder, elements, stations, until, duration):
+@click.option('--concurrency', default=1, type=click.IntRange(1), help='Number of time periods to download at the same time')
+@click.option('--request-size', default=50000, type=click.IntRange(1), help='Approximate number of observations to ask for in each request')
+@click.option('--incremental', is_flag=True, help='Only get data since the previous incremental download, as recorded in a sync_state.json file in each station folder')
+@click.option('--lookback', default=48, type=click.IntRange(0), help='With --incremental, also get this many hours of data before the previous download, to pick up late corrections')
+@click.option('--batch-size', default=1, type=click.IntRange(1), help='Number of stations to get in each request')
+@click.option('--format', 'file_format', default='json', type=click.Choice(['json', 'npz']), help='Format of written files. npz files are compact, and only contain the observations write netcdf would use')
+@click.option('--time-offset', 'time_offsets', multiple=True, default=['PT00H'], help='timeOffset to use when frost has several observations for the same parameter, in order of preference. Only used for npz files, which must be written with the same options as they are read with. May be specified multiple times')
+@click.option('--time-resolution', 'time_resolutions', multiple=True, default=['PT1H'], help='Preferred timeResolution when frost has several observations for the same parameter and time offset. May be specified multiple times')
+def observations(ctx, output_folder, elements, stations, until, duration, concurrency, request_size, incremental, lookback, batch_size, file_format, time_offsets, time_resolutions):
     '''Store observations into a set of files. Will print a list of all written files to stdout.'''
     time_range = _get_time_range(until, duration)
     frost = ctx.obj['frost']
     files = []
-    for s in stations:
-        logging.info('Reading station ' + s)
-        files += frost_extract.read_frost.save(frost, s, elements, time_range, output_folder)
+    for i in range(0, len(stations), batch_size):
+        batch = stations[i:i + batch_size]
+        logging.info('Reading stations ' + ', '.join(batch))
+        sync_states = None
+        if incremental:
+            sync_states = {s: SyncState(frost_extract.read_frost.get_sync_state_file(output_folder, s)) for s in batch}
+        station_files = frost_extract.read_frost.save_batch(frost, batch, elements, time_range, output_folder, concurrency, request_size, sync_states, timedelta(hours=lookback), file_format, SelectionRules(time_offsets, time_resolutions))
+        for s in batch:
+            files += station_files[s]
+    logging.info('Opened %d connections, reused %d' % (frost.connections_opened, frost.connections_reused))
+    frost.close()
     print(' '.join(files))
 
 
@@ -83,6 +138,37 @@ def source(ctx, station):
     print(json.dumps(frost.get_source(station)))
 
 
+@click.command()
+@click.option('--server', default='frost.met.no', envvar='FROST_SERVER', help='name of frost server to connect to, or its full url')
+@click.option('--key', prompt=True, hide_input=True, envvar='FROST_KEY', help='API key for frost')
+@click.option('--rate', default=0, type=click.FloatRange(0), help='Maximum number of requests per second to send to frost, shared by all concurrent downloads. 0 means no limit')
+@click.option('--retries', default=5, type=click.IntRange(0), help='Number of times to retry requests that fail because of throttling, server errors or network problems')
+@click.option('--catalogue', 'catalogue_file', envvar='FROST_CATALOGUE', type=click.Path(dir_okay=False, writable=True), help='Cache frost elements and sources in this file, and only ask frost for them again when older than --catalogue-ttl. The file may also be given to write netcdf --elements')
+@click.option('--catalogue-ttl', default=24, type=click.FloatRange(0), help='Hours before cached elements and sources are refreshed. Unchanged data is not downloaded again, if frost supports it')
+@click.option('--output', '-o', 'output_folder', default='.', type=click.Path(file_okay=False, writable=True), help='Folder to write netcdf files into. Files will be named after the station.')
+@click.option('--archive', '-j', 'archive_folder', type=click.Path(file_okay=False, writable=True), help='Also store downloaded data in this folder, the same way as download observations and download elements/source do.')
+@click.option('--archive-format', default='json', type=click.Choice(['json', 'npz']), help='Format of files in the --archive folder')
+@click.option('--element', '-e', 'elements', multiple=True, default=default_elements, help='Parameters to get from frost. Specify multiple times to get several parameters')
+@click.option('--duration', default=3, type=int, help='Duration back in time to get data for, in months')
+@click.option('--lookback', default=48, type=click.IntRange(0), help='Also get and write this many hours of data before the previous run, to pick up late corrections')
+@click.option('--jobs', default=4, type=click.IntRange(1), help='Number of stations to process at the same time')
+@click.option('--concurrency', default=1, type=click.IntRange(1), help='Number of time periods to download at the same time for each station')
+@click.option('--profile', default='default', type=click.Choice(list(storage_profiles)), help='Chunking and compression settings for new netcdf variables')
+@click.option('--time-offset', 'time_offsets', multiple=True, default=['PT00H'], help='timeOffset to use when frost has several observations for the same parameter, in order of preference. May be specified multiple times')
+@click.option('--time-resolution', 'time_resolutions', multiple=True, default=['PT1H'], help='Preferred timeResolution when frost has several observations for the same parameter and time offset. May be specified multiple times')
+@click.argument('stations', nargs=-1, required=True)
+def sync(server, key, rate, retries, catalogue_file, catalogue_ttl, output_folder, archive_folder, archive_format, elements, duration, lookback, jobs, concurrency, profile, time_offsets, time_resolutions, stations):
+    '''Download new observations for the given stations from frost, and write or append them to netcdf files, all in a single process.'''
+    import frost_extract.sync
+    frost = _frost_api(server, key, rate, retries, catalogue_file, catalogue_ttl)
+    time_range = _get_time_range(None, duration)
+    failed = frost_extract.sync.sync(frost, stations, elements, time_range, output_folder, archive_folder, jobs, concurrency, timedelta(hours=lookback), archive_format, profile, SelectionRules(time_offsets, time_resolutions))
+    logging.info('Opened %d connections, reused %d' % (frost.connections_opened, frost.connections_reused))
+    frost.close()
+    if failed:
+        raise click.ClickException('Failed to sync ' + ' '.join(failed))
+
+
 @click.group()
 def write():
     '''Process data downloaded via frost download, and generate various outputs.'''
@@ -93,22 +179,133 @@ def write():
 @click.option('--source', '-s', type=click.Path(), help='Name of file to read frost sources information from')
 @click.option('--elements', '-e', type=click.Path(), help='Name of file to read frost elements information from')
 @click.option('--append', '-a', is_flag=True, help='Append to an existing file instead of creating a new one')
+@click.option('--sync-state', type=click.Path(), help='State file, as written by download observations --incremental. When appending, only data since the previous write minus --lookback is written, or since the start of any later download that has not been written yet')
+@click.option('--lookback', default=48, type=click.IntRange(0), help='With --sync-state, also rewrite this many hours of data before the previous write')
+@click.option('--profile', default='default', type=click.Choice(list(storage_profiles)), help='Chunking and compression settings for new variables')
+@click.option('--time-offset', 'time_offsets', multiple=True, default=['PT00H'], help='timeOffset to use when frost has several observations for the same parameter, in order of preference. May be specified multiple times')
+@click.option('--time-resolution', 'time_resolutions', multiple=True, default=['PT1H'], help='Preferred timeResolution when frost has several observations for the same parameter and time offset. May be specified multiple times')
 @click.argument('input_files', nargs=-1)
-def netcdf(output_file, source, elements, append, input_files):
-    '''Write or append to a netcdf file'''
-    w = NetcdfWriter()
+def netcdf(output_file, source, elements, append, sync_state, lookback, profile, time_offsets, time_resolutions, input_files):
+    '''Write or append to a netcdf file, from json or npz files written by download observations'''
+    from frost_extract.write_netcdf import NetcdfWriter
+    w = NetcdfWriter(profile, SelectionRules(time_offsets, time_resolutions))
     w.add_observations(input_files)
-    w.write(output_file, source, elements, append)
+    since = None
+    if sync_state:
+        if not output_file:
+            raise click.UsageError('--sync-state requires --output')
+        sync_state = SyncState(sync_state)
+        written_until = sync_state.written_until(output_file)
+        if append:
+            since = sync_state.write_since(output_file, timedelta(hours=lookback))
+    w.write(output_file, source, elements, append, since)
+    if sync_state and w.last_time() is not None:
+        if not sync_state.set_written(output_file, max(w.last_time(), written_until or w.last_time())):
+            logging.warning('Not updating sync state, since the last download was incomplete')
+        sync_state.save()
+
+@write.command()
+@click.option('--output', '-o', 'output_folder', default='.', type=click.Path(file_okay=False, writable=True), help='Folder to write netcdf files into. Files will be named after the station, unless the manifest says otherwise')
+@click.option('--elements', '-e', type=click.Path(exists=True, dir_okay=False), help='Name of file to read frost elements information from. Default is elements.json in the archive folder. Required with a manifest')
+@click.option('--append', '-a', is_flag=True, help='Append to existing files instead of creating new ones')
+@click.option('--months', type=click.IntRange(1), help='With an archive folder, only read this many of the latest month files for each station, such as when appending recent data')
+@click.option('--format', 'file_format', default='json', type=click.Choice(['json', 'npz']), help='Format of the month files to read from an archive folder')
+@click.option('--jobs', type=click.IntRange(1), help='Number of stations to write at the same time. Default is the number of processors')
+@click.option('--profile', default='default', type=click.Choice(list(storage_profiles)), help='Chunking and compression settings for new variables')
+@click.option('--time-offset', 'time_offsets', multiple=True, default=['PT00H'], help='timeOffset to use when frost has several observations for the same parameter, in order of preference. May be specified multiple times')
+@click.option('--time-resolution', 'time_resolutions', multiple=True, default=['PT1H'], help='Preferred timeResolution when frost has several observations for the same parameter and time offset. May be specified multiple times')
+@click.argument('input', type=click.Path(exists=True))
+@click.argument('stations', nargs=-1)
+def batch(output_folder, elements, append, months, file_format, jobs, profile, time_offsets, time_resolutions, input, stations):
+    '''Write or append to netcdf files for many stations in parallel. INPUT is either a folder as written by sync --archive, or a json manifest: a list of objects with station, source, files and optionally output. With a folder, all stations in it are written, unless some STATIONS are given. Will print a list of all written files to stdout.'''
+    import frost_extract.batch
+    from frost_extract.write_netcdf import load_elements
+    if os.path.isdir(input):
+        station_jobs = frost_extract.batch.archive_jobs(input, output_folder, stations, file_format, months)
+        elements = elements or os.path.join(input, 'elements.json')
+    else:
+        if not elements:
+            raise click.UsageError('--elements is required with a manifest')
+        station_jobs = frost_extract.batch.read_manifest(input, output_folder)
+        if stations:
+            station_jobs = [job for job in station_jobs if job['station'] in stations]
+    written, failed = frost_extract.batch.write_batch(station_jobs, load_elements(elements), append, jobs, profile, SelectionRules(time_offsets, time_resolutions))
+    print(' '.join(written[job['station']] for job in station_jobs if job['station'] in written))
+    if failed:
+        raise click.ClickException('Failed to write ' + ', '.join('%s (%s)' % f for f in sorted(failed.items())))
+
+@write.command()
+@click.option('--output', '-o', 'output_file', required=True, type=click.Path(dir_okay=False, writable=True), help='Name of netcdf file to write.')
+@click.option('--archive', '-j', 'archive_folder', required=True, type=click.Path(exists=True, file_okay=False), help='Folder with data from download observations or sync --archive. Station information is read from <station>.json files in it')
+@click.option('--elements', '-e', type=click.Path(exists=True, dir_okay=False), help='Name of file to read frost elements information from. Default is elements.json in the archive folder')
+@click.option('--layout', default='orthogonal', type=click.Choice(list(collection_layouts)), help='orthogonal gives all stations the same time axis, and may be appended to in place. ragged only stores the time steps each station has, but is rewritten on append')
+@click.option('--append', '-a', is_flag=True, help='Append to an existing file instead of creating a new one')
+@click.option('--months', type=click.IntRange(1), help='Only read this many of the latest month files for each station, such as when appending recent data')
+@click.option('--format', 'file_format', default='json', type=click.Choice(['json', 'npz']), help='Format of the month files to read')
+@click.option('--profile', default='default', type=click.Choice(list(storage_profiles)), help='Chunking and compression settings for new variables')
+@click.option('--time-offset', 'time_offsets', multiple=True, default=['PT00H'], help='timeOffset to use when frost has several observations for the same parameter, in order of preference. May be specified multiple times')
+@click.option('--time-resolution', 'time_resolutions', multiple=True, default=['PT1H'], help='Preferred timeResolution when frost has several observations for the same parameter and time offset. May be specified multiple times')
+@click.argument('stations', nargs=-1)
+def collection(output_file, archive_folder, elements, layout, append, months, file_format, profile, time_offsets, time_resolutions, stations):
+    '''Write or append to a single netcdf file with data from many stations, as a CF timeSeries collection. If no stations are given, all stations in the archive folder are used.'''
+    if not stations:
+        stations = frost_extract.read_frost.find_stations(archive_folder)
+    from frost_extract.write_netcdf import CollectionWriter
+    w = CollectionWriter(layout, profile, SelectionRules(time_offsets, time_resolutions))
+    for station in stations:
+        with open(os.path.join(archive_folder, station + '.json')) as f:
+            source = json.load(f)
+        files = frost_extract.read_frost.find_month_files(os.path.join(archive_folder, station), file_format)
+        if months:
+            files = files[-months:]
+        w.add_station(source, files)
+    w.write(output_file, elements or os.path.join(archive_folder, 'elements.json'), append)
+
+@write.command()
+@click.option('--chunk-size', default=65536, type=click.IntRange(1), help='Number of time steps to copy at a time')
+@click.argument('nc_files', nargs=-1, type=click.Path(exists=True, dir_okay=False))
+def compact(chunk_size, nc_files):
+    '''Sort the time axis of netcdf files written by write netcdf, so that they may be sliced by time. Appends keep files sorted, and only look at the end of the time axis when adding data, so files written by older versions should be compacted before appending to them.'''
+    import frost_extract.write_netcdf
+    for f in nc_files:
+        if frost_extract.write_netcdf.compact(f, chunk_size):
+            logging.info('Sorted ' + f)
+
+@write.command()
+@click.option('--remove', is_flag=True, help='Remove the json files after converting them')
+@click.option('--time-offset', 'time_offsets', multiple=True, default=['PT00H'], help='timeOffset to use when frost has several observations for the same parameter, in order of preference. The npz files must be read with the same options. May be specified multiple times')
+@click.option('--time-resolution', 'time_resolutions', multiple=True, default=['PT1H'], help='Preferred timeResolution when frost has several observations for the same parameter and time offset. May be specified multiple times')
+@click.argument('paths', nargs=-1, type=click.Path(exists=True))
+def npz(remove, time_offsets, time_resolutions, paths):
+    '''Convert json month files from download observations to the compact npz format. Arguments may be files, or folders to search for month files. Will print a list of all written files to stdout.'''
+    selection_rules = SelectionRules(time_offsets, time_resolutions)
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            json_files = frost_extract.read_frost.find_month_files(path)
+        else:
+            json_files = [path]
+        for f in json_files:
+            files.append(frost_extract.read_frost.convert_to_npz(f, selection_rules))
+            if remove:
+                os.remove(f)
+    print(' '.join(files))
 
 @write.command()
-@click.option('--output', '-o', 'output_folder', type=click.Path(writable=True), help='Name of folder to write mmd files into. File name will be determined by wigos id')
+@click.option('--output', '-o', 'output_folder', default='.', type=click.Path(file_okay=False, writable=True), help='Name of folder to write mmd files into. File name will be determined by wigos id')
 @click.option('--location', '-l', help='The announced opendap location to use in documents')
-@click.argument('nc_file', nargs=-1)
-def mmd(output_folder, location, nc_file):
-    '''Write mmd metadata file, based on the given netcdf file'''
-    for f in nc_file:
-        loc = location
-        frost_extract.metadata.render_metadata(output_folder, f, loc)
+@click.option('--jobs', default=1, type=click.IntRange(1), help='Number of processes to render documents with')
+@click.option('--incremental', is_flag=True, help='Skip netcdf files that have not changed since the previous incremental run, as recorded in .mmd_state.json in the output folder')
+@click.option('--check', default='mtime', type=click.Choice(['mtime', 'digest']), help='With --incremental, how to tell if a netcdf file has changed. digest also compares the content of files whose size or modification time has changed')
+@click.argument('nc_file', nargs=-1, type=click.Path(exists=True, dir_okay=False))
+def mmd(output_folder, location, jobs, incremental, check, nc_file):
+    '''Write mmd metadata files, based on the given netcdf files'''
+    os.makedirs(output_folder, exist_ok=True)
+    import frost_extract.metadata
+    rendered, skipped, failed = frost_extract.metadata.render_all(output_folder, nc_file, location, jobs, check if incremental else None)
+    logging.info('Wrote metadata for %d files, skipped %d unchanged' % (len(rendered), len(skipped)))
+    if failed:
+        raise click.ClickException('Failed to write metadata for ' + ' '.join(failed))
 
 
 download.add_command(observations)
@@ -116,6 +313,7 @@ download.add_command(elements)
 download.add_command(source)
 write.add_command(netcdf)
 cli.add_command(download)
+cli.add_command(sync)
 cli.add_command(write)
 
 
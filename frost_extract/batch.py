@@ -0,0 +1,107 @@
+from concurrent.futures import ProcessPoolExecutor
+import json
+import logging
+import os
+import shutil
+import frost_extract.read_frost as read_frost
+from frost_extract.write_netcdf import NetcdfWriter
+
+# Settings for the station writes in a worker process, set by _init_worker
+_settings = {}
+
+
+def archive_jobs(archive_folder, output_folder, stations=None, format='json', months=None):
+    '''Get a job for each station in a folder written by download
+    observations or sync --archive, as for write_batch. If months is given,
+    only that many of the latest month files are used.'''
+    jobs = []
+    for station in stations or read_frost.find_stations(archive_folder):
+        files = read_frost.find_month_files(os.path.join(archive_folder, station), format)
+        if months:
+            files = files[-months:]
+        jobs.append({
+            'station': station,
+            'source': os.path.join(archive_folder, station + '.json'),
+            'files': files,
+            'output': os.path.join(output_folder, station + '.nc'),
+        })
+    return jobs
+
+
+def read_manifest(file_name, output_folder):
+    '''Read jobs for write_batch from a json manifest, which is a list of
+    objects with station, source and files, and optionally output. Relative
+    paths are taken to be relative to the manifest. output defaults to
+    <station>.nc in output_folder.'''
+    folder = os.path.dirname(os.path.abspath(file_name))
+    path = lambda p: os.path.join(folder, p)
+    with open(file_name) as f:
+        manifest = json.load(f)
+    jobs = []
+    for entry in manifest:
+        if 'station' not in entry or 'source' not in entry:
+            raise RuntimeError('Manifest entries need a station and a source: ' + json.dumps(entry))
+        jobs.append({
+            'station': entry['station'],
+            'source': path(entry['source']),
+            'files': [path(f) for f in entry.get('files', [])],
+            'output': path(entry['output']) if 'output' in entry else os.path.join(output_folder, entry['station'] + '.nc'),
+        })
+    return jobs
+
+
+def write_batch(jobs, elements, append=False, processes=None, storage_profile='default', selection_rules=None):
+    '''Write a netcdf file for each job, using a pool of processes. A job is
+    a dict with station, source (the frost source file), files (the json or
+    npz files to read observations from) and output (the netcdf file to
+    write). elements is a dict of frost elements by id, which is passed to
+    each process once. Files are written to a temporary name, and only
+    replace the output file when complete. Returns a dict of written files by
+    station, and a dict of error messages for the stations that failed.'''
+    written = {}
+    failed = {}
+    if not jobs:
+        return written, failed
+    # Start with the biggest stations, so that no process is left with a
+    # big one at the end
+    jobs = sorted(jobs, key=lambda job: -sum(os.path.getsize(f) for f in job['files'] if os.path.exists(f)))
+    settings = (elements, append, storage_profile, selection_rules)
+    with ProcessPoolExecutor(max_workers=min(processes or os.cpu_count() or 1, len(jobs)), initializer=_init_worker, initargs=settings) as executor:
+        futures = [(job['station'], executor.submit(_write_station, job)) for job in jobs]
+        for station, future in futures:
+            try:
+                written[station] = future.result()
+            except Exception as e:
+                logging.error('Failed to write %s: %s' % (station, e))
+                failed[station] = '%s: %s' % (type(e).__name__, e)
+    return written, failed
+
+
+def _init_worker(elements, append, storage_profile, selection_rules):
+    _settings.update(elements=elements, append=append, storage_profile=storage_profile, selection_rules=selection_rules)
+
+
+def _write_station(job):
+    '''Write the netcdf file for a single job, in a process set up by
+    _init_worker. Returns the name of the written file.'''
+    output = job['output']
+    logging.info('Writing %s to %s' % (job['station'], output))
+    writer = NetcdfWriter(_settings['storage_profile'], _settings['selection_rules'])
+    writer.add_observations(job['files'])
+    with open(job['source']) as f:
+        source = json.load(f)
+
+    append = _settings['append'] and os.path.exists(output)
+    folder = os.path.dirname(output)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    tmp_name = '%s.%d.tmp' % (output, os.getpid())
+    try:
+        if append:
+            shutil.copyfile(output, tmp_name)
+        writer.write_to(tmp_name, source, _settings['elements'], append)
+        os.replace(tmp_name, output)
+    finally:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+    return output
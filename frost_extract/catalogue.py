@@ -0,0 +1,164 @@
+from collections.abc import Mapping
+from datetime import timedelta
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+# The first bytes of every sqlite database file
+_sqlite_header = b'SQLite format 3\0'
+
+_schema = '''
+create table if not exists items (
+    kind text not null,
+    id text not null,
+    data text not null,
+    primary key (kind, id)
+);
+create table if not exists fetches (
+    name text primary key,
+    fetched real not null,
+    etag text,
+    last_modified text
+);
+'''
+
+
+class Catalogue(object):
+    '''Local cache of frost elements and sources, kept in an sqlite
+    database, so that single entries can be looked up by id without reading
+    the whole catalogue. Entries older than ttl are fetched again when asked
+    for, sending the validators from the previous fetch, so that the server
+    may answer that nothing has changed. If a refresh fails, the old entries
+    are used, with a warning.
+
+    Fetch functions are given the validators of the previous fetch, as a
+    (etag, last_modified) pair or None, and return (data, validators), with
+    data None if the server said nothing has changed.'''
+
+    def __init__(self, file_name, ttl=timedelta(days=1)):
+        self._file_name = file_name
+        self._ttl = ttl.total_seconds()
+        folder = os.path.dirname(file_name)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self._lock = threading.Lock()
+        # Set when new elements have been stored
+        self.elements_refreshed = False
+        self._db = sqlite3.connect(file_name, check_same_thread=False)
+        self._db.executescript(_schema)
+
+    def close(self):
+        self._db.close()
+
+    def get_elements(self, fetch=None):
+        '''Get a list of all elements, refreshing them with fetch if they are
+        out of date'''
+        self.refresh_elements(fetch)
+        with self._lock:
+            rows = self._db.execute("select data from items where kind = 'element' order by rowid").fetchall()
+        return [json.loads(data) for data, in rows]
+
+    def get_element_lookup(self, fetch=None):
+        '''Get a read-only dict of elements by id, refreshing them with fetch
+        if they are out of date. Elements are only read when looked up.'''
+        self.refresh_elements(fetch)
+        return ElementLookup(self._file_name)
+
+    def refresh_elements(self, fetch):
+        if fetch is None or self._is_fresh('elements'):
+            return
+        data = self._refresh('elements', fetch)
+        if data is None:
+            return
+        with self._lock, self._db:
+            self._db.execute("delete from items where kind = 'element'")
+            self._db.executemany("insert into items values ('element', ?, ?)", [(e['id'], json.dumps(e)) for e in data])
+        self.elements_refreshed = True
+        logging.info('Stored %d elements in %s' % (len(data), self._file_name))
+
+    def get_source(self, station, fetch=None):
+        '''Get frost source information for a station, refreshing it with
+        fetch if it is out of date. fetch is called with the station and the
+        validators. Raises KeyError if the station is unknown.'''
+        name = 'source:' + station
+        if fetch is not None and not self._is_fresh(name):
+            data = self._refresh(name, lambda validators: fetch(station, validators))
+            if data is not None:
+                with self._lock, self._db:
+                    self._db.execute("insert or replace into items values ('source', ?, ?)", (station, json.dumps(data)))
+        with self._lock:
+            row = self._db.execute("select data from items where kind = 'source' and id = ?", (station,)).fetchone()
+        if row is None:
+            raise KeyError('No source information for ' + station)
+        return json.loads(row[0])
+
+    def _is_fresh(self, name):
+        with self._lock:
+            row = self._db.execute('select fetched from fetches where name = ?', (name,)).fetchone()
+        return row is not None and time.time() - row[0] < self._ttl
+
+    def _refresh(self, name, fetch):
+        '''Call fetch with the validators stored for name, and record the
+        fetch. Returns the fetched data, or None if it has not changed.'''
+        with self._lock:
+            row = self._db.execute('select etag, last_modified from fetches where name = ?', (name,)).fetchone()
+        try:
+            data, validators = fetch(row)
+        except Exception as e:
+            if row is None:
+                raise
+            logging.warning('Using old %s, since refreshing failed: %s' % (name, e))
+            return None
+        if data is None:
+            logging.debug('%s has not changed' % (name,))
+        with self._lock, self._db:
+            self._db.execute('insert or replace into fetches values (?, ?, ?, ?)', (name, time.time()) + tuple(validators or (None, None)))
+        return data
+
+
+class ElementLookup(Mapping):
+    '''Read-only dict of frost elements by id, backed by a catalogue file.
+    Looked up elements are remembered. May be pickled, and used from
+    several threads.'''
+
+    def __init__(self, file_name):
+        self._file_name = file_name
+        self._found = {}
+        self._db = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return self._file_name
+
+    def __setstate__(self, file_name):
+        self.__init__(file_name)
+
+    def _query(self, sql, args=()):
+        with self._lock:
+            if self._db is None:
+                self._db = sqlite3.connect('file:%s?mode=ro' % (self._file_name,), uri=True, check_same_thread=False)
+            return self._db.execute(sql, args).fetchall()
+
+    def __getitem__(self, element_id):
+        if element_id not in self._found:
+            rows = self._query("select data from items where kind = 'element' and id = ?", (element_id,))
+            self._found[element_id] = json.loads(rows[0][0]) if rows else None
+        element = self._found[element_id]
+        if element is None:
+            raise KeyError(element_id)
+        return element
+
+    def __iter__(self):
+        return iter([element_id for element_id, in self._query("select id from items where kind = 'element' order by rowid")])
+
+    def __len__(self):
+        return self._query("select count(*) from items where kind = 'element'")[0][0]
+
+
+def is_catalogue(file_name):
+    '''Check if a file is a catalogue, rather than a json file'''
+    with open(file_name, 'rb') as f:
+        return f.read(len(_sqlite_header)) == _sqlite_header
@@ -1,43 +1,100 @@
+from concurrent.futures import ProcessPoolExecutor
+import functools
+import hashlib
 from jinja2 import Environment, PackageLoader, select_autoescape
+import json
+import logging
 import netCDF4
 from datetime import datetime, timezone
 import os
 import sys
 
 def render_metadata(output_folder, nc_file, announced_location):
-    '''Generate a metadata document from the given netcdf file'''
+    '''Generate a metadata document from the given netcdf file. Returns the
+    name of the written file.'''
     metadata = get_metadata(nc_file)
-    render(output_folder, announced_location, **metadata)
+    return render(output_folder, announced_location, **metadata)
 
-def get_metadata(nc_file):
-    '''Extract metadata from the given netcdf file'''
-    ret = {}
-    dataset = netCDF4.Dataset(nc_file, 'r', format='NETCDF4')
+def render_all(output_folder, nc_files, announced_location, jobs=1, check=None, state_file=None):
+    '''Generate metadata documents for many netcdf files, using up to jobs
+    processes. If check is 'mtime', files that have the same size and
+    modification time as when they were last rendered are skipped. If check
+    is 'digest', files that have been modified are only rendered again if
+    their content has changed. What has been rendered is recorded in
+    state_file, by default .mmd_state.json in output_folder. Returns lists
+    of rendered, skipped and failed netcdf files.'''
+    if state_file is None:
+        state_file = os.path.join(output_folder or '.', '.mmd_state.json')
+    state = RenderState(state_file) if check else None
+
+    rendered, skipped, failed, todo = [], [], [], []
+    stats = {}
+    for nc_file in nc_files:
+        # Taken before rendering, so that later changes are not missed
+        stats[nc_file] = os.stat(nc_file)
+        if state is not None and state.is_unchanged(nc_file, stats[nc_file], announced_location, check == 'digest'):
+            skipped.append(nc_file)
+        else:
+            todo.append(nc_file)
 
-    ret['station_name'] = dataset.station_name
-    ret['wigos'] = dataset.wigos
+    def done(nc_file, result):
+        try:
+            output_file = result()
+        except Exception:
+            logging.exception('Failed to write metadata for ' + nc_file)
+            failed.append(nc_file)
+            return
+        rendered.append(nc_file)
+        if state is not None:
+            state.set_rendered(nc_file, stats[nc_file], announced_location, output_file, check == 'digest')
 
-    ret['latitude'] = dataset.variables['latitude'][0]
-    ret['longitude'] = dataset.variables['longitude'][0]
-    times = dataset.variables['time']
-    if times:
-        ret['start_date'] = datetime.fromtimestamp(times[0], tz=timezone.utc)
+    if jobs > 1 and len(todo) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [(f, executor.submit(render_metadata, output_folder, f, announced_location)) for f in todo]
+            for nc_file, future in futures:
+                done(nc_file, future.result)
     else:
-        ret['start_date'] = ''
+        for nc_file in todo:
+            done(nc_file, functools.partial(render_metadata, output_folder, nc_file, announced_location))
 
-    return ret
+    if state is not None:
+        state.save()
+    return rendered, skipped, failed
 
+def get_metadata(nc_file):
+    '''Extract metadata from the given netcdf file, reading only the few
+    attributes and values needed.'''
+    ret = {}
+    with netCDF4.Dataset(nc_file, 'r') as dataset:
+        ret['station_name'] = dataset.getncattr('station_name')
+        ret['wigos'] = dataset.getncattr('wigos_identifier')
 
+        ret['latitude'] = dataset.variables['latitude'][0]
+        ret['longitude'] = dataset.variables['longitude'][0]
+        times = dataset.variables['time']
+        if times.shape[0]:
+            ret['start_date'] = datetime.fromtimestamp(float(times[0]), tz=timezone.utc)
+        else:
+            ret['start_date'] = ''
 
-def render(output_folder, announced_location, station_name, wigos, start_date, latitude, longitude):
-    '''Generate metadata template'''
+    return ret
+
+
+@functools.lru_cache(maxsize=None)
+def _template():
     env = Environment(
         loader=PackageLoader('frost_extract', 'templates'),
         autoescape=select_autoescape(['xml'])
     )
-    template = env.get_template('mmd.xml')
+    return env.get_template('mmd.xml')
 
-    with open('%s/%s.xml' % (output_folder, wigos), 'w', encoding='utf-8') as f:
+def render(output_folder, announced_location, station_name, wigos, start_date, latitude, longitude):
+    '''Generate metadata template. The template is only compiled once per
+    process. Returns the name of the written file.'''
+    template = _template()
+
+    file_name = '%s/%s.xml' % (output_folder, wigos)
+    with open(file_name, 'w', encoding='utf-8') as f:
         metadata = template.render(
             announced_location=announced_location, 
             station_name=station_name, 
@@ -46,10 +103,68 @@ def render(output_folder, announced_location, station_name, wigos, start_date, l
             latitude=latitude, 
             longitude=longitude)
         f.write(metadata)
+    return file_name
+
+
+class RenderState(object):
+    '''Record of which netcdf files metadata has been rendered from, and
+    what they looked like at the time, stored as a small json file.'''
+
+    def __init__(self, file_name):
+        self._file_name = file_name
+        try:
+            with open(file_name) as f:
+                self._state = json.load(f)
+        except FileNotFoundError:
+            self._state = {}
+
+    def is_unchanged(self, nc_file, stat, announced_location, use_digest=False):
+        '''Check if nc_file, with the given os.stat result, is the same as
+        when it was last rendered, with the same announced_location, and the
+        rendered file still exists.'''
+        entry = self._state.get(os.path.abspath(nc_file))
+        if entry is None or entry['location'] != announced_location or not os.path.exists(entry['output']):
+            return False
+        if [stat.st_size, stat.st_mtime_ns] == [entry['size'], entry['mtime_ns']]:
+            return True
+        if use_digest and entry.get('digest') == _digest(nc_file):
+            # Touched or rewritten with the same content
+            entry['size'], entry['mtime_ns'] = stat.st_size, stat.st_mtime_ns
+            return True
+        return False
+
+    def set_rendered(self, nc_file, stat, announced_location, output_file, use_digest=False):
+        entry = {
+            'location': announced_location,
+            'output': os.path.abspath(output_file),
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+        }
+        if use_digest:
+            entry['digest'] = _digest(nc_file)
+        self._state[os.path.abspath(nc_file)] = entry
+
+    def save(self):
+        folder = os.path.dirname(self._file_name)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        tmp_name = '%s.%d.tmp' % (self._file_name, os.getpid())
+        with open(tmp_name, 'w') as f:
+            json.dump(self._state, f, indent=1, sort_keys=True)
+        os.replace(tmp_name, self._file_name)
+
+
+def _digest(file_name):
+    h = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
 
 if __name__ == '__main__':
     for nc_file in sys.argv[1:]:
         print(nc_file)
         output_folder = os.path.dirname(nc_file) or '.'
         print('Render to ' + output_folder)
-        render_metadata(output_folder, nc_file)
+        render_metadata(output_folder, nc_file, None)
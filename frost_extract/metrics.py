@@ -0,0 +1,114 @@
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+
+# Rates included in summaries, as (name, counter, stage)
+_rates = [
+    ('observations_downloaded_per_second', 'observations_downloaded', 'save'),
+    ('observations_read_per_second', 'observations_read', 'selection'),
+    ('values_written_per_second', 'values_written', 'write'),
+    ('http_bytes_per_second', 'http_bytes', 'http'),
+]
+
+
+class Metrics(object):
+    '''Counters, and timers for the stages of a run, such as http requests,
+    json parsing, selection of observations, unit conversion and netcdf
+    writes. Stage times are summed over all threads, so with concurrent
+    downloads they may add up to more than the time the run took.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}
+            self._seconds = {}
+            self._calls = {}
+            self._started = time.time()
+
+    def count(self, name, n=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def add_seconds(self, stage, seconds):
+        with self._lock:
+            self._seconds[stage] = self._seconds.get(stage, 0.0) + seconds
+            self._calls[stage] = self._calls.get(stage, 0) + 1
+
+    @contextmanager
+    def timer(self, stage):
+        '''Add the time spent in a with block to the given stage'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_seconds(stage, time.perf_counter() - start)
+
+    def summary(self):
+        '''Get all counters, stage times and rates as a dict'''
+        with self._lock:
+            counters = dict(self._counters)
+            seconds = dict(self._seconds)
+            calls = dict(self._calls)
+            started = self._started
+        rates = {}
+        for name, counter, stage in _rates:
+            if counters.get(counter) and seconds.get(stage):
+                rates[name] = counters[counter] / seconds[stage]
+        return {
+            'started': started,
+            'run_seconds': time.time() - started,
+            'counters': counters,
+            'seconds': seconds,
+            'calls': calls,
+            'rates': rates,
+        }
+
+    def write(self, file_name):
+        '''Write a summary to file_name, as a prometheus textfile if the name
+        ends with .prom, and otherwise as json.'''
+        if file_name.endswith('.prom'):
+            text = self.prometheus()
+        else:
+            text = json.dumps(self.summary(), indent=1, sort_keys=True) + '\n'
+        folder = os.path.dirname(file_name)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        # Write and rename, so that collectors never see a partial file
+        tmp_name = '%s.%d.tmp' % (file_name, os.getpid())
+        with open(tmp_name, 'w') as f:
+            f.write(text)
+        os.replace(tmp_name, file_name)
+
+    def prometheus(self, prefix='frost_extract'):
+        '''Get a summary in the prometheus text exposition format, as used
+        by node_exporter's textfile collector. Values are for the last run,
+        so they are all gauges.'''
+        summary = self.summary()
+        lines = []
+
+        def gauge(name, help, samples):
+            lines.append('# HELP %s_%s %s' % (prefix, name, help))
+            lines.append('# TYPE %s_%s gauge' % (prefix, name))
+            for labels, value in samples:
+                lines.append('%s_%s%s %s' % (prefix, name, labels, repr(float(value))))
+
+        gauge('last_run_timestamp_seconds', 'Time the last run started.', [('', summary['started'])])
+        gauge('run_seconds', 'Duration of the last run.', [('', summary['run_seconds'])])
+        for name, value in sorted(summary['counters'].items()):
+            gauge(name, 'Number of %s in the last run.' % (name.replace('_', ' '),), [('', value)])
+        gauge('stage_seconds', 'Seconds spent in each stage in the last run, summed over threads.',
+              [('{stage="%s"}' % (stage,), value) for stage, value in sorted(summary['seconds'].items())])
+        gauge('stage_calls', 'Number of times each stage was entered in the last run.',
+              [('{stage="%s"}' % (stage,), value) for stage, value in sorted(summary['calls'].items())])
+        for name, value in sorted(summary['rates'].items()):
+            gauge(name, 'Rate in the last run.', [('', value)])
+        return '\n'.join(lines) + '\n'
+
+
+# Metrics for everything done by this process
+metrics = Metrics()
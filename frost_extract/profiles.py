@@ -0,0 +1,26 @@
+# These are kept apart from write_netcdf, so that the command line program
+# can offer them as choices without loading netCDF4.
+
+# netCDF4.default_fillvals['f4']
+_default_fill_value = 9.969209968386869e+36
+
+# Settings for creating the time and data variables in netcdf files. Appends
+# are cheapest with small chunks and light compression, while reading whole
+# series, as over OPeNDAP, is fastest with large, well compressed chunks.
+storage_profiles = {
+    'default': {
+        'time': {'zlib': True},
+        'data': {'zlib': True},
+    },
+    'append-optimized': {
+        'time': {'zlib': True, 'complevel': 1, 'shuffle': False, 'chunksizes': (512,), 'fill_value': False},
+        'data': {'zlib': True, 'complevel': 1, 'shuffle': False, 'chunksizes': (512,), 'fill_value': _default_fill_value},
+    },
+    'read-optimized': {
+        'time': {'zlib': True, 'complevel': 6, 'shuffle': True, 'chunksizes': (8760,), 'fill_value': False},
+        'data': {'zlib': True, 'complevel': 6, 'shuffle': True, 'chunksizes': (8760,), 'fill_value': _default_fill_value},
+    },
+}
+
+# Ways of storing many stations in one file, see CollectionWriter
+collection_layouts = ('orthogonal', 'ragged')
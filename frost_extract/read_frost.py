@@ -1,34 +1,236 @@
+import base64
+from concurrent.futures import ThreadPoolExecutor
+import email.utils
+import gzip
+import http.client
+import io
 import json
 import logging
 import os
+import random
+import re
 import sys
+import threading
+import time
 import urllib
-import urllib.request
+import urllib.parse
 import urllib.error
-from datetime import datetime, date
+import urllib.request
+from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
+from frost_extract.metrics import metrics
+
+
+class ConnectionPool(object):
+    '''Keep-alive connections to a single http(s) server, which may be
+    shared between threads. Proxies are taken from the environment, such as
+    https_proxy and no_proxy, as urllib does.'''
+
+    def __init__(self, base_url, timeout=120):
+        url = urllib.parse.urlsplit(base_url)
+        if url.scheme == 'https':
+            self._connection_type = http.client.HTTPSConnection
+        else:
+            self._connection_type = http.client.HTTPConnection
+        self._host = url.netloc
+        self._timeout = timeout
+        self._proxy = _get_proxy(url)
+        self._proxy_headers = {}
+        # Plain http requests through a proxy name the whole url
+        self._path_prefix = ''
+        if self._proxy is not None:
+            if self._proxy.username:
+                credentials = urllib.parse.unquote(self._proxy.username) + ':' + urllib.parse.unquote(self._proxy.password or '')
+                self._proxy_headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(credentials.encode('utf8')).decode('ascii')
+            if url.scheme != 'https':
+                self._path_prefix = 'http://' + self._host
+        self._idle = []
+        self._lock = threading.Lock()
+        self.connections_opened = 0
+        self.connections_reused = 0
+
+    def get(self, path, headers):
+        '''Send a GET request, returning the response and its body.'''
+        while True:
+            connection, reused = self._acquire()
+            try:
+                if self._path_prefix:
+                    connection.request('GET', self._path_prefix + path, headers=dict(headers, **self._proxy_headers))
+                else:
+                    connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                if reused:
+                    # The server may have closed the connection while it was idle
+                    continue
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self._release(connection)
+            return response, body
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+    def _acquire(self):
+        with self._lock:
+            if self._idle:
+                self.connections_reused += 1
+                return self._idle.pop(), True
+            self.connections_opened += 1
+        if self._proxy is None:
+            return self._connection_type(self._host, timeout=self._timeout), False
+        if self._path_prefix:
+            return http.client.HTTPConnection(self._proxy.hostname, self._proxy.port, timeout=self._timeout), False
+        # https goes through a tunnel, with the proxy only seeing CONNECT
+        connection = self._connection_type(self._proxy.hostname, self._proxy.port, timeout=self._timeout)
+        connection.set_tunnel(self._host, headers=self._proxy_headers)
+        return connection, False
+
+    def _release(self, connection):
+        with self._lock:
+            self._idle.append(connection)
+
+
+def _get_proxy(url):
+    '''Get the split url of the proxy to use for url, or None'''
+    proxy = urllib.request.getproxies().get(url.scheme)
+    if not proxy or urllib.request.proxy_bypass(url.hostname):
+        return None
+    if '://' not in proxy:
+        proxy = 'http://' + proxy
+    return urllib.parse.urlsplit(proxy)
+
+
+class RateLimiter(object):
+    '''Token bucket limiting requests to rate per second on average, with
+    bursts of up to burst requests, shared between threads. A rate of None
+    means no limit. The limiter may also be paused, when the server has
+    asked us to wait.'''
+
+    def __init__(self, rate=None, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''Wait until a request may be sent'''
+        with self._lock:
+            now = time.monotonic()
+            wait = self._paused_until - now
+            if self.rate:
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                # Taking a token we do not have yet reserves the next one,
+                # so that waiting threads are served in turn
+                self._tokens -= 1
+                if self._tokens < 0:
+                    wait = max(wait, -self._tokens / self.rate)
+        if wait > 0:
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        '''Hold back all requests for the given number of seconds'''
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class RetryPolicy(object):
+    '''Decides which failed requests to retry, and how long to wait
+    before doing so. Waits grow exponentially from base_delay, up to
+    max_delay, with full jitter so that concurrent workers spread out.
+    Retry-After from the server is obeyed, up to max_retry_after.'''
+
+    retry_statuses = (429, 500, 502, 503, 504)
+
+    def __init__(self, attempts=6, base_delay=1.0, max_delay=60.0, max_retry_after=600.0):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+
+    def should_retry(self, attempt, status):
+        '''attempt counts from 0. status is None for connection errors'''
+        if attempt + 1 >= self.attempts:
+            return False
+        return status is None or status in self.retry_statuses
+
+    def delay(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return min(retry_after, self.max_retry_after) + random.uniform(0, self.base_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+def _retry_after(response):
+    '''Get the number of seconds a Retry-After header asks for, or None'''
+    value = response.getheader('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
 
 
 class FrostApi(object):
 
-    def __init__(self, base_url, user_id):
-        password_manager = urllib.request.HTTPPasswordMgrWithDefaultRealm()
-        password_manager.add_password(None, base_url, user_id, '')
-        handler = urllib.request.HTTPBasicAuthHandler(password_manager)
-        self._url_opener = urllib.request.build_opener(handler)
-        
+    def __init__(self, base_url, user_id, rate_limiter=None, retry_policy=None, catalogue=None):
+        '''rate_limiter is a RateLimiter for all requests, which may be
+        shared with other clients. retry_policy is a RetryPolicy. If
+        catalogue is given, it is a Catalogue caching elements and sources.'''
         if base_url.endswith('/'):
             base_url = base_url[:-1]
         self._base_url = base_url
-        
-        self._elements_cache = {}
+
+        self._pool = ConnectionPool(base_url)
+        self._limiter = rate_limiter or RateLimiter()
+        self._retry = retry_policy or RetryPolicy()
+        credentials = base64.b64encode((user_id + ':').encode('utf8')).decode('ascii')
+        self._headers = {
+            'Authorization': 'Basic ' + credentials,
+            'Accept-Encoding': 'gzip'
+            }
+
+        self._catalogue = catalogue
+
+    @property
+    def connections_opened(self):
+        return self._pool.connections_opened
+
+    @property
+    def connections_reused(self):
+        return self._pool.connections_reused
+
+    def close(self):
+        self._pool.close()
 
     def _timerange_format(self, time_range):
         format = lambda t: datetime.strftime(t, '%Y-%m-%dT%H:%M:%SZ')
         return format(time_range[0]) + '/' + format(time_range[1])
 
+    def _sources_format(self, stations):
+        if isinstance(stations, str):
+            return stations
+        return ','.join(stations)
+
     def get_available_elements(self, station, time_range, element_filter):
-        args = {'sources': station,
+        '''Get available time series for the given station, or list of
+        stations.'''
+        args = {'sources': self._sources_format(station),
                 'elements': ','.join(element_filter),
                 'referencetime': self._timerange_format(time_range)
                 }
@@ -37,12 +239,14 @@ class FrostApi(object):
         return self._execute_query(url)
 
     def get_data(self, station, elements, time_range):
+        '''Get observations for the given station, or list of stations. Each
+        returned entry has a sourceId telling which station it is from.'''
         time_from = time_range[0]
         time_to = time_range[1]
         
         arguments = {
-            'sources': station,
-            'elements': ','.join([e['elementId'] for e in elements])
+            'sources': self._sources_format(station),
+            'elements': ','.join(dict.fromkeys(e['elementId'] for e in elements))
             }
         # if 'level' in element:
         #     arguments['levels'] = element['level']['value']            
@@ -50,6 +254,8 @@ class FrostApi(object):
 
     def get_source(self, station):
         if station:
+            if self._catalogue is not None:
+                return self._catalogue.get_source(station, self._fetch_source)
             url = self._create_query('sources', ids=station)
             return self._make_single_return_value_query(url)
         else:
@@ -57,25 +263,67 @@ class FrostApi(object):
             return self._execute_query(url)
 
     def get_elements(self):
+        if self._catalogue is not None:
+            return self._catalogue.get_elements(self._fetch_elements)
         url = self._create_query('elements')
         return self._execute_query(url)
+
+    @property
+    def elements_changed(self):
+        '''Whether elements have been downloaded by this object, rather
+        than only read from the catalogue'''
+        return self._catalogue is None or self._catalogue.elements_refreshed
+
+    def get_element_lookup(self):
+        '''Get a dict of all elements by id. With a catalogue, elements are
+        only read from it when looked up.'''
+        if self._catalogue is not None:
+            return self._catalogue.get_element_lookup(self._fetch_elements)
+        return {e['id']: e for e in self.get_elements()}
+
+    def _fetch_elements(self, validators):
+        return self._conditional_query(self._create_query('elements'), validators)
+
+    def _fetch_source(self, station, validators):
+        url = self._create_query('sources', ids=station)
+        data, validators = self._conditional_query(url, validators)
+        if data is not None:
+            if not data:
+                raise KeyError('No data returned for url: ' + url)
+            data = data[0]
+        return data, validators
+
+    def _conditional_query(self, url, validators):
+        '''Run a query, asking the server to only send data if it has changed
+        since the query that returned the given (etag, last_modified)
+        validators. Returns the data, or None if it has not changed, and the
+        new validators.'''
+        headers = {}
+        if validators is not None:
+            etag, last_modified = validators
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        try:
+            response, data = self._query(url, headers)
+        except urllib.error.HTTPError as e:
+            if e.getcode() == 304:
+                metrics.count('http_not_modified')
+                return None, validators
+            raise
+        return data, (response.getheader('ETag'), response.getheader('Last-Modified'))
                 
-    def _get_data(self, time_from, time_to, args, retried_on=[]):
+    def _get_data(self, time_from, time_to, args):
         try:
             args['referencetime'] = self._timerange_format((time_from, time_to))
             url = self._create_query('observations', **args)
             return self._execute_query(url)
         except urllib.error.HTTPError as e:
-            code = e.getcode()
-            if code == 404:
+            if e.getcode() == 404:
                 # no data
                 return []
-            else:
-                if code not in retried_on:
-                    logging.warning('Got %d from server, retrying' % (code,))
-                    return self._get_data(time_from, time_to, args, retried_on + [code])
-                else:
-                    raise
+            raise
 
     def _create_query(self, service, **parameters):
         ret = self._base_url + '/' + service + '/v0.jsonld?' + urllib.parse.urlencode(parameters)
@@ -83,10 +331,55 @@ class FrostApi(object):
         return ret
         
     def _execute_query(self, url):
+        return self._query(url)[1]
+
+    def _query(self, url, headers=None):
+        '''Get url, retrying as the retry policy allows, with any extra
+        headers. Returns the response and its decoded data.'''
         logging.getLogger(__name__).debug(url)
-        response = self._url_opener.open(url)
-        ret = json.loads(str(response.read(), 'utf8'))['data']
-        return ret
+        query = urllib.parse.urlsplit(url)
+        if headers:
+            headers = dict(self._headers, **headers)
+        else:
+            headers = self._headers
+        attempt = 0
+        while True:
+            self._limiter.acquire()
+            try:
+                with metrics.timer('http'):
+                    response, body = self._pool.get(query.path + '?' + query.query, headers)
+            except (http.client.HTTPException, OSError) as e:
+                metrics.count('http_errors')
+                if not self._retry.should_retry(attempt, None):
+                    raise
+                delay = self._retry.delay(attempt)
+                logging.warning('Request failed (%s), retrying in %.1f seconds' % (e, delay))
+            else:
+                metrics.count('http_requests')
+                metrics.count('http_bytes', len(body))
+                if response.status == 200:
+                    break
+                if response.status != 304:
+                    metrics.count('http_errors')
+                if not self._retry.should_retry(attempt, response.status):
+                    if response.getheader('Content-Encoding') == 'gzip':
+                        body = gzip.decompress(body)
+                    raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(body))
+                retry_after = _retry_after(response)
+                delay = self._retry.delay(attempt, retry_after)
+                if retry_after is not None:
+                    # The server is throttling us, so every worker must wait
+                    self._limiter.pause(delay)
+                logging.warning('Got %d from server, retrying in %.1f seconds' % (response.status, delay))
+            metrics.count('http_retries')
+            time.sleep(delay)
+            attempt += 1
+
+        if response.getheader('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        with metrics.timer('json'):
+            ret = json.loads(str(body, 'utf8'))['data']
+        return response, ret
 
     def _make_single_return_value_query(self, url):
         ret = self._execute_query(url)
@@ -98,56 +391,319 @@ class FrostApi(object):
 
 
 
-def save(frost, station, wanted_elements, time_range, base_folder):
+def save(frost, station, wanted_elements, time_range, base_folder, concurrency=1, observations_per_request=50000, sync_state=None, lookback=timedelta(hours=48), format='json', selection_rules=None):
+    '''Download observations for station into month files below base_folder,
+    returning the names of all files written. If a SyncState is given, only
+    data from lookback before the previous download is fetched, and
+    existing month files are updated instead of overwritten.'''
+    sync_states = {station: sync_state} if sync_state is not None else None
+    files = save_batch(frost, [station], wanted_elements, time_range, base_folder, concurrency, observations_per_request, sync_states, lookback, format, selection_rules)
+    return files[station]
+
+
+def save_batch(frost, stations, wanted_elements, time_range, base_folder, concurrency=1, observations_per_request=50000, sync_states=None, lookback=timedelta(hours=48), format='json', selection_rules=None):
+    '''Like save, but get data for all the given stations in the same
+    requests. Returns a dict with the list of written files per station.
+    sync_states, if given, is a dict with a SyncState per station.'''
+    files = {s: [] for s in stations}
+    with metrics.timer('save'):
+        for station, month, data in fetch_batch(frost, stations, wanted_elements, time_range, concurrency, observations_per_request, sync_states, lookback):
+            with metrics.timer('store'):
+                files[station].append(store_month(base_folder, station, month, data, sync_states is not None, format, selection_rules))
+        if sync_states is not None:
+            for state in sync_states.values():
+                state.save()
+    return files
+
+
+def fetch_batch(frost, stations, wanted_elements, time_range, concurrency=1, observations_per_request=50000, sync_states=None, lookback=timedelta(hours=48)):
+    '''Download observations for the given stations, yielding (station,
+    (month_start, month_end), data) for every station and month with data,
+    in time order. If sync_states are given, they are used to limit the time range,
+    and updated (but not saved) once everything has been downloaded.'''
     try:
-        elements = frost.get_available_elements(station, time_range, wanted_elements)
+        elements = frost.get_available_elements(stations, time_range, wanted_elements)
     except urllib.error.HTTPError as e:
         if e.getcode() != 404:
             logging.warning(e)
-        return []
+        return
 
-    lowest_time = min([datetime.strptime(e['validFrom'][:7], '%Y-%m').date() for e in elements])
-    time_from = max(lowest_time, time_range[0])
-    time_to = time_range[1]
-    tr = time_from, time_to
+    available_stations = {}
+    for e in elements:
+        station = _station_of(e['sourceId'], stations)
+        if station is None:
+            logging.warning('Ignoring %s from %s, which was not asked for' % (e['elementId'], e['sourceId']))
+            continue
+        available_stations.setdefault(station, []).append(e)
+    elements = [e for station_elements in available_stations.values() for e in station_elements]
+    stations = [s for s in stations if s in available_stations]
 
-    if tr != time_range:
-        logging.info('Adjusting time range to %s - %s to match actual observations' % tr)
-        time_range = tr
+    if sync_states is not None:
+        # The batch starts where the station furthest behind needs it to
+        starts = []
+        for s in stations:
+            fetched_until = sync_states[s].fetched_until(set(e['elementId'] for e in available_stations[s]))
+            if not fetched_until:
+                break
+            starts.append(fetched_until - lookback)
+        else:
+            start = max(min(starts, default=_as_datetime(time_range[0])), _as_datetime(time_range[0]))
+            if start > _as_datetime(time_range[0]):
+                time_range = start, time_range[1]
+                logging.info('Only getting data since %s for %s' % (time_range[0], ', '.join(stations)))
+
+    periods = plan_periods(elements, time_range, observations_per_request)
+    logging.info('Reading %s in %d requests' % (', '.join(stations), len(periods)))
 
-    files = []
-    for period in _time_iter(time_range):
+    def fetch(period):
         try:
-            d = frost.get_data(station, elements, period)
-            file_name = get_file_name(base_folder, station, period)
-            os.makedirs(os.path.dirname(file_name), exist_ok=True)
-            with open(file_name, 'w') as f:
-                json.dump(d, f)
-            files.append(file_name)
+            return frost.get_data(stations, elements, period)
         except urllib.error.HTTPError as e:
             if e.getcode() != 404:
                 logging.warning(e)
-    files.reverse()
-    return files
+            return None
+
+    complete = True
+    latest = {s: {} for s in stations}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # map returns results in period order, whatever order they complete in
+        for period, d in zip(periods, executor.map(fetch, periods)):
+            sys.stderr.write('\r%s - %s' % period)
+            if d is None:
+                complete = False
+                continue
+            metrics.count('observations_downloaded', sum(len(timestep['observations']) for timestep in d))
+            by_station = {s: [] for s in stations}
+            unknown = set()
+            for timestep in d:
+                station = _station_of(timestep['sourceId'], stations)
+                if station in by_station:
+                    by_station[station].append(timestep)
+                else:
+                    unknown.add(timestep['sourceId'])
+            if unknown:
+                logging.warning('Ignoring observations from %s, which was not asked for' % (', '.join(sorted(unknown)),))
+            for station, station_data in by_station.items():
+                months = _split_months(station_data)
+                for month in _month_iter(period):
+                    # Months without data are still counted as downloaded
+                    # in the sync state, but give no files
+                    month_data = months.get((month[0].year, month[0].month))
+                    if month_data:
+                        yield station, month, month_data
+                latest_reference_times(station_data, latest[station])
+
+    if sync_states is not None:
+        for s in stations:
+            sync_states[s].record_fetch(_as_datetime(time_range[0]), complete)
+        if complete:
+            for s in stations:
+                sync_states[s].update_fetched(latest[s])
+        else:
+            logging.warning('Not updating sync state for %s, since some downloads failed' % (', '.join(stations),))
+
+
+def latest_reference_times(data, latest=None):
+    '''Get a dict with the latest referenceTime per element in the given
+    frost observations data, updating latest if given.'''
+    if latest is None:
+        latest = {}
+    for timestep in data:
+        t = timestep['referenceTime']
+        for obs in timestep['observations']:
+            element_id = obs['elementId']
+            if t > latest.get(element_id, ''):
+                latest[element_id] = t
+    return latest
+
+
+def _station_of(source_id, stations):
+    '''Get which of the requested stations a frost sourceId, such as
+    SN18700:0, belongs to, or None if it is none of them, as when frost has
+    renamed or merged a source.'''
+    if source_id in stations:
+        return source_id
+    station = source_id.split(':')[0]
+    if station in stations:
+        return station
+    return None
+
+
+def store_month(base_folder, station, month, data, update=False, format='json', selection_rules=None):
+    '''Write data for a (part of a) month to its file below base_folder,
+    returning the file name. If update is true and month does not cover a
+    whole month, only the given part of an existing file is replaced.
+    format may be json, for frost's own format, or npz for a compact binary
+    file with only the observations chosen by selection_rules.'''
+    file_name = get_file_name(base_folder, station, month, format)
+    merge = update and not _is_whole_month(month)
+    if format == 'npz':
+        from frost_extract.write_netcdf import NetcdfWriter
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        writer = NetcdfWriter(selection_rules=selection_rules)
+        writer.add_observation_data(data)
+        if merge and os.path.exists(file_name):
+            writer.save_observations(file_name, file_name, month)
+        else:
+            writer.save_observations(file_name)
+        return file_name
+    if merge:
+        data = _merge_month(file_name, data, month)
+    write_json(file_name, data)
+    return file_name
+
+
+def write_json(file_name, data):
+    '''Write data to file_name, so that readers never see a partial file'''
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    tmp_name = '%s.%d.tmp' % (file_name, os.getpid())
+    with open(tmp_name, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_name, file_name)
+
+
+def _merge_month(file_name, data, time_range):
+    '''Replace the data within time_range in an existing month file with the
+    given data.'''
+    try:
+        with open(file_name) as f:
+            existing = json.load(f) or []
+    except FileNotFoundError:
+        return data
+    start, end = [datetime.strftime(t, '%Y-%m-%dT%H:%M:%S') for t in time_range]
+    kept = [timestep for timestep in existing if not start <= timestep['referenceTime'] < end]
+    return sorted(kept + data, key=lambda timestep: timestep['referenceTime'])
 
 
-def _time_iter(time_range, offset=relativedelta(months=1)):
-    if time_range:
-        start = time_range[1]
-        end = time_range[0]
-    else:
-        start = date(2018,3,1)
-        end = date(1850, 1, 1)
-    while start > end:
-        next = start - offset
-        sys.stderr.write('\r%s - %s' % (next, start))
-        yield next, start
-        start = next
+def _is_whole_month(time_range):
+    start, end = time_range
+    return start == datetime(start.year, start.month, 1) and end == start + relativedelta(months=1)
+
+
+def _split_months(data):
+    ret = {}
+    for timestep in data:
+        t = timestep['referenceTime']
+        ret.setdefault((int(t[:4]), int(t[5:7])), []).append(timestep)
+    return ret
+
+
+def plan_periods(available, time_range, observations_per_request=50000, max_months=120):
+    '''Split time_range into periods to request from frost, based on the
+    given availableTimeSeries entries. Months without any available series
+    are skipped, and consecutive months are joined into one period as long as
+    the expected number of observations stays below observations_per_request.
+    Periods start and end on month boundaries, unless time_range does not.'''
+    series = [_parse_series(a) for a in available]
+    start = _as_datetime(time_range[0])
+    end = _as_datetime(time_range[1])
+
+    periods = []
+    period_start = None
+    for month_start, month_end in _month_iter((start, end)):
+        expected = sum(_expected_observations(s, month_start, month_end) for s in series)
+        if period_start is not None:
+            if expected == 0 or count + expected > observations_per_request or months == max_months:
+                periods.append((period_start, month_start))
+                period_start = None
+        if expected > 0:
+            if period_start is None:
+                period_start, count, months = month_start, 0, 0
+            count += expected
+            months += 1
+    if period_start is not None:
+        periods.append((period_start, end))
+    return periods
+
+
+def _month_iter(time_range):
+    '''Yield (start, end) for each month in time_range, clipped to the range'''
+    start, end = time_range
+    month = datetime(start.year, start.month, 1)
+    while month < _as_datetime(end):
+        next_month = month + relativedelta(months=1)
+        yield max(month, _as_datetime(start)), min(next_month, _as_datetime(end))
+        month = next_month
+
+
+def _as_datetime(t):
+    if isinstance(t, datetime):
+        return t
+    return datetime(t.year, t.month, t.day)
+
+
+def _parse_series(available):
+    valid_from = _parse_time(available['validFrom'])
+    valid_to = available.get('validTo')
+    if valid_to:
+        valid_to = _parse_time(valid_to)
+    resolution = _duration_seconds(available.get('timeResolution', ''))
+    if not resolution:
+        # Unknown resolution: assume minute data, which gives monthly requests
+        resolution = 60
+    return valid_from, valid_to, resolution
+
+
+def _expected_observations(series, time_from, time_to):
+    valid_from, valid_to, resolution = series
+    overlap_from = max(time_from, valid_from)
+    overlap_to = min(time_to, valid_to) if valid_to else time_to
+    if overlap_to <= overlap_from:
+        return 0
+    return (overlap_to - overlap_from).total_seconds() / resolution
+
+
+def _parse_time(t):
+    return datetime.strptime(t[:19], '%Y-%m-%dT%H:%M:%S')
+
+
+_duration_pattern = re.compile(r'P(?:(\d+)Y)?(?:(\d+)M)?(?:(\d+)W)?(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$')
+_duration_units = (365.25 * 86400, 30.44 * 86400, 7 * 86400, 86400, 3600, 60, 1)
+
+def _duration_seconds(duration):
+    '''Get the approximate length of an ISO-8601 duration, such as PT1H'''
+    match = _duration_pattern.match(duration)
+    if not match:
+        return None
+    return sum(int(n) * unit for n, unit in zip(match.groups(), _duration_units) if n)
 
 
 def get_folder(base_folder, station):
     return '%s/%s/' % (base_folder, station)
 
-def get_file_name(base_folder, station, time_range):
-    ret = '%s/%s/%s.json' % (get_folder(base_folder, station), time_range[0].year, datetime.strftime(time_range[0], '%m'))
+def get_file_name(base_folder, station, time_range, format='json'):
+    ret = '%s/%s/%s.%s' % (get_folder(base_folder, station), time_range[0].year, datetime.strftime(time_range[0], '%m'), format)
     return ret
+
+
+def convert_to_npz(json_file, selection_rules=None):
+    '''Convert a month file from json to npz format, keeping the
+    observations chosen by selection_rules. Returns the name of the new
+    file.'''
+    from frost_extract.write_netcdf import NetcdfWriter
+    npz_file = os.path.splitext(json_file)[0] + '.npz'
+    writer = NetcdfWriter(selection_rules=selection_rules)
+    writer.add_observations([json_file])
+    writer.save_observations(npz_file)
+    return npz_file
+
+
+def find_month_files(folder, format='json'):
+    '''Find all month files of the given format below folder, sorted by name'''
+    pattern = re.compile(r'\d{4}/\d{2}\.' + format + '$')
+    ret = []
+    for root, dirs, files in os.walk(folder):
+        for f in files:
+            path = os.path.join(root, f)
+            if pattern.search(path.replace(os.sep, '/')):
+                ret.append(path)
+    ret.sort()
+    return ret
+
+def find_stations(folder):
+    '''Find all stations with both a source file and a folder of month
+    files in folder, as written by sync --archive, sorted by name'''
+    return sorted(s for s in os.listdir(folder) if os.path.isdir(os.path.join(folder, s)) and os.path.exists(os.path.join(folder, s + '.json')))
+
+def get_sync_state_file(base_folder, station):
+    return get_folder(base_folder, station) + 'sync_state.json'
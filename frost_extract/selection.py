@@ -0,0 +1,90 @@
+import logging
+
+
+class SelectionRules(object):
+    '''Rules for naming frost observations as output variables, and for
+    choosing which observation to use when several in a time step get the
+    same name. Among such candidates, those with a timeOffset in
+    time_offsets are used, preferring earlier entries in time_offsets, and
+    then earlier entries in time_resolutions.
+
+    Names and priorities are worked out once for each combination of
+    elementId, level, timeOffset and timeResolution. Likewise, the choice of
+    observations is worked out once for each distinct list of such
+    combinations in a time step, so that most time steps only need a table
+    lookup.'''
+
+    # Limit on the number of remembered time step layouts
+    max_plans = 10000
+
+    def __init__(self, time_offsets=('PT00H',), time_resolutions=('PT1H',)):
+        self.time_offsets = list(time_offsets)
+        self.time_resolutions = list(time_resolutions)
+        self._time_offsets = {o: i for i, o in enumerate(time_offsets)}
+        self._time_resolutions = {r: i for i, r in enumerate(time_resolutions)}
+        self._compiled = {}
+        self._plans = {}
+
+    def compile(self, obs):
+        '''Get (name, priority) for an observation. Lower priorities are
+        better, and a priority of None means the observation may only be used
+        if it is the only candidate.'''
+        return self._compile(_key(obs))
+
+    def select(self, observations):
+        '''Select which of a time step's observations to use, returning a
+        list of (name, observation) pairs.'''
+        keys = tuple([_key(obs) for obs in observations])
+        plan = self._plans.get(keys)
+        if plan is None:
+            if len(self._plans) >= self.max_plans:
+                self._plans.clear()
+            plan = self._plans[keys] = self._plan(keys)
+        selected, failed = plan
+        if failed:
+            logging.warning('Failed to find suitable candidates for ' + ', '.join(failed))
+        return [(name, observations[i]) for i, name in selected]
+
+    def _plan(self, keys):
+        '''Get the (index, name) of each observation to use in a time step
+        with the given observation keys, and the names no observation could
+        be chosen for.'''
+        selected = {}
+        conflicts = {}
+        for i, key in enumerate(keys):
+            name, priority = self._compile(key)
+            if name in selected:
+                conflicts.setdefault(name, [selected[name]]).append((priority, i))
+            selected[name] = priority, i
+
+        failed = []
+        for name, candidates in conflicts.items():
+            eligible = [c for c in candidates if c[0] is not None]
+            best = min([priority for priority, i in eligible], default=None)
+            best_candidates = [c for c in eligible if c[0] == best]
+            if len(best_candidates) == 1:
+                selected[name] = best_candidates[0]
+            else:
+                del selected[name]
+                failed.append(name)
+        return [(i, name) for name, (priority, i) in selected.items()], failed
+
+    def _compile(self, key):
+        ret = self._compiled.get(key)
+        if ret is None:
+            element_id, level_value, level_unit, time_offset, time_resolution = key
+            name = element_id.replace('(', '_').replace(')', '_').replace(' ', '_').strip('_')
+            if level_unit is not None:
+                name += '_%d%s' % (level_value, level_unit)
+            priority = None
+            if time_offset in self._time_offsets:
+                priority = self._time_offsets[time_offset], self._time_resolutions.get(time_resolution, len(self._time_resolutions))
+            ret = self._compiled[key] = name, priority
+        return ret
+
+
+def _key(obs):
+    level = obs.get('level')
+    if level:
+        return obs['elementId'], level['value'], level['unit'], obs.get('timeOffset', 'PT00H'), obs.get('timeResolution', 'PT1H')
+    return obs['elementId'], None, None, obs.get('timeOffset', 'PT00H'), obs.get('timeResolution', 'PT1H')
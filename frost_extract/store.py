@@ -0,0 +1,167 @@
+import logging
+import numpy
+import os
+import struct
+import zipfile
+
+
+class ObservationStore(object):
+    '''Observations for a single station, kept as a growable array of times
+    and one value array per variable, aligned with the times. Missing values
+    are stored as NaN.'''
+
+    def __init__(self, capacity=1024):
+        self._size = 0
+        self._times = numpy.empty(capacity, dtype='f8')
+        self._values = {}
+        self._elements = {}
+
+    def __len__(self):
+        return self._size
+
+    def add_time(self, seconds):
+        '''Add a time step, and return the row to set its values in.'''
+        if self._size == len(self._times):
+            self._grow()
+        row = self._size
+        self._times[row] = seconds
+        self._size += 1
+        return row
+
+    def set_value(self, row, name, element_id, value):
+        values = self._values.get(name)
+        if values is None:
+            values = numpy.full(len(self._times), numpy.nan, dtype='f4')
+            self._values[name] = values
+            self._elements[name] = element_id
+        values[row] = value
+
+    def extend(self, times, variables, element_ids):
+        '''Add many time steps at once. variables is a dict of value arrays
+        aligned with times, and element_ids has the element id of each
+        variable.'''
+        while self._size + len(times) > len(self._times):
+            self._grow()
+        rows = slice(self._size, self._size + len(times))
+        self._times[rows] = times
+        for name, values in variables.items():
+            if name not in self._values:
+                self._values[name] = numpy.full(len(self._times), numpy.nan, dtype='f4')
+                self._elements[name] = element_ids[name]
+            self._values[name][rows] = values
+        self._size += len(times)
+
+    def add_file(self, file_name, exclude=None):
+        '''Add observations from a file written by save. If exclude is a
+        (start, end) pair of seconds since epoch, observations within that
+        range are skipped. Returns the selection settings saved with the
+        observations, which are empty for files from older versions.'''
+        arrays = load_arrays(file_name)
+        times = arrays['time']
+        rows = slice(None)
+        if exclude is not None:
+            rows = (times < exclude[0]) | (times >= exclude[1])
+        names = [str(n) for n in arrays['names']]
+        variables = {n: arrays['values'][i][rows] for i, n in enumerate(names)}
+        element_ids = {n: str(e) for n, e in zip(names, arrays['element_ids'])}
+        self.extend(times[rows], variables, element_ids)
+        return {n[len('selection_'):]: [str(v) for v in a] for n, a in arrays.items() if n.startswith('selection_')}
+
+    def save(self, file_name, selection=None):
+        '''Write all observations to an uncompressed npz file, which may
+        later be memory mapped by load_arrays. selection is a dict of lists
+        of strings, telling how the observations were selected.'''
+        names = self.names()
+        values = numpy.empty((len(names), self._size), dtype='f4')
+        for i, name in enumerate(names):
+            values[i] = self._values[name][:self._size]
+        tmp_name = '%s.%d.tmp' % (file_name, os.getpid())
+        with open(tmp_name, 'wb') as f:
+            numpy.savez(f,
+                time=self._times[:self._size],
+                values=values,
+                names=numpy.array(names, dtype='U'),
+                element_ids=numpy.array([self._elements[n] for n in names], dtype='U'),
+                **{'selection_' + k: numpy.array(v, dtype='U') for k, v in (selection or {}).items()})
+        os.replace(tmp_name, file_name)
+
+    def names(self):
+        return list(self._values.keys())
+
+    def element_id(self, name):
+        return self._elements[name]
+
+    def last_time(self):
+        if not self._size:
+            return None
+        return float(self._times[:self._size].max())
+
+    def timeseries(self, since=None):
+        '''Get the sorted, unique times of all observations, and a dict with
+        an array of values for those times per variable name. If a variable
+        has several values for the same time, the last one added is used.
+        If since is given, only observations from that time on are included.'''
+        times = self._times[:self._size]
+        rows = slice(None)
+        if since is not None:
+            rows = times >= since
+            times = times[rows]
+        unique, inverse = numpy.unique(times, return_inverse=True)
+        variables = {}
+        for name, values in self._values.items():
+            values = values[:self._size][rows]
+            if len(unique) == len(times):
+                merged = numpy.full(len(unique), numpy.nan, dtype='f4')
+                merged[inverse] = values
+            else:
+                merged = self._merge_duplicates(name, values, inverse, len(unique))
+            variables[name] = merged
+        return unique, variables
+
+    def _merge_duplicates(self, name, values, inverse, size):
+        rows = numpy.flatnonzero(~numpy.isnan(values))[::-1]
+        targets, first = numpy.unique(inverse[rows], return_index=True)
+        if len(targets) < len(rows):
+            logging.warning('%d duplicate values for %s' % (len(rows) - len(targets), name))
+        merged = numpy.full(size, numpy.nan, dtype='f4')
+        merged[targets] = values[rows[first]]
+        return merged
+
+    def _grow(self):
+        capacity = 2 * len(self._times)
+        self._times = _resized(self._times, capacity, 0)
+        for name, values in self._values.items():
+            self._values[name] = _resized(values, capacity, numpy.nan)
+
+
+def _resized(array, capacity, fill_value):
+    ret = numpy.full(capacity, fill_value, dtype=array.dtype)
+    ret[:len(array)] = array
+    return ret
+
+
+def load_arrays(file_name):
+    '''Get all arrays in an npz file, as a dict. Arrays that are stored
+    uncompressed, as ObservationStore.save does, are memory mapped instead of
+    read.'''
+    ret = {}
+    with zipfile.ZipFile(file_name) as z, open(file_name, 'rb') as f:
+        for info in z.infolist():
+            name = info.filename[:-len('.npy')]
+            if info.compress_type != zipfile.ZIP_STORED:
+                ret[name] = numpy.load(z.open(info))
+                continue
+            # Skip the zip local file header to get to the npy data
+            f.seek(info.header_offset + 26)
+            name_length, extra_length = struct.unpack('<HH', f.read(4))
+            f.seek(name_length + extra_length, os.SEEK_CUR)
+            version = numpy.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = numpy.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = numpy.lib.format.read_array_header_2_0(f)
+            if dtype.hasobject or 0 in shape:
+                ret[name] = numpy.load(z.open(info))
+            else:
+                ret[name] = numpy.memmap(f, dtype=dtype, mode='r', offset=f.tell(), shape=shape, order='F' if fortran_order else 'C')
+    return ret
@@ -0,0 +1,81 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import logging
+import os
+import threading
+import frost_extract.read_frost as read_frost
+from frost_extract.metrics import metrics
+from frost_extract.sync_state import SyncState
+from frost_extract.write_netcdf import NetcdfWriter
+
+# netCDF4/HDF5 is not thread safe, so only one file is written at a time
+_netcdf_lock = threading.Lock()
+
+
+def sync(frost, stations, wanted_elements, time_range, output_folder, archive_folder=None, jobs=4, concurrency=1, lookback=timedelta(hours=48), archive_format='json', storage_profile='default', selection_rules=None):
+    '''Download new observations for all the given stations, and write them
+    to <station>.nc files in output_folder. If archive_folder is given, the
+    downloaded data is also stored there, the same way as download
+    observations does. Returns a list of the stations that failed.'''
+    elements = frost.get_element_lookup()
+    if archive_folder:
+        elements_file = os.path.join(archive_folder, 'elements.json')
+        # Reading every element from a catalogue is slow, so only do it when
+        # something may have changed
+        if frost.elements_changed or not os.path.exists(elements_file):
+            read_frost.write_json(elements_file, list(elements.values()))
+
+    def run(station):
+        try:
+            with metrics.timer('sync'):
+                sync_station(frost, station, elements, wanted_elements, time_range, output_folder, archive_folder, concurrency, lookback, archive_format, storage_profile, selection_rules)
+            metrics.count('stations_synced')
+            return True
+        except Exception:
+            logging.exception('Failed to sync ' + station)
+            metrics.count('stations_failed')
+            return False
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(run, stations))
+    return [s for s, ok in zip(stations, results) if not ok]
+
+
+def sync_station(frost, station, elements, wanted_elements, time_range, output_folder, archive_folder=None, concurrency=1, lookback=timedelta(hours=48), archive_format='json', storage_profile='default', selection_rules=None):
+    '''Download new observations for a single station, and write them to
+    its netcdf file. elements is a dict of frost elements by id.'''
+    source = frost.get_source(station)
+    if archive_folder:
+        read_frost.write_json(os.path.join(archive_folder, station + '.json'), source)
+
+    output_file = os.path.join(output_folder, station + '.nc')
+    append = os.path.exists(output_file)
+    sync_state = SyncState(read_frost.get_sync_state_file(archive_folder or output_folder, station))
+    if not append:
+        # The state is of no use if the netcdf file must be made from scratch
+        sync_state.clear()
+
+    writer = NetcdfWriter(storage_profile, selection_rules)
+    # Timed the same way as download observations
+    with metrics.timer('save'):
+        for _, month, data in read_frost.fetch_batch(frost, [station], wanted_elements, time_range, concurrency, sync_states={station: sync_state}, lookback=lookback):
+            if archive_folder:
+                with metrics.timer('store'):
+                    read_frost.store_month(archive_folder, station, month, data, True, archive_format, selection_rules)
+            writer.add_observation_data(data)
+
+    last_time = writer.last_time()
+    if last_time is None:
+        logging.info('No new data for ' + station)
+        sync_state.save()
+        return
+
+    written_until = sync_state.written_until(output_file)
+    since = None
+    if append:
+        since = sync_state.write_since(output_file, lookback)
+    with _netcdf_lock:
+        writer.write_to(output_file, source, elements, append, since)
+    if not sync_state.set_written(output_file, max(last_time, written_until or last_time)):
+        logging.warning('Some downloads failed for %s, so they will be written again next time' % (station,))
+    sync_state.save()
@@ -0,0 +1,94 @@
+import calendar
+from datetime import datetime
+import json
+import os
+
+
+class SyncState(object):
+    '''Record of how far data for a station has been downloaded and written
+    to netcdf, so that later runs may only process what is new. The state is
+    stored as a small json file.'''
+
+    def __init__(self, file_name):
+        self._file_name = file_name
+        try:
+            with open(file_name) as f:
+                self._state = json.load(f)
+        except FileNotFoundError:
+            self._state = {}
+        self._state.setdefault('fetched', {})
+        self._state.setdefault('written', {})
+
+    def clear(self):
+        '''Forget everything that has been downloaded and written'''
+        self._state = {'fetched': {}, 'written': {}}
+
+    def fetched_until(self, element_ids):
+        '''Get the latest time all the given elements have been downloaded
+        for, or None if any of them has never been downloaded.'''
+        fetched = self._state['fetched']
+        if not element_ids or any(e not in fetched for e in element_ids):
+            return None
+        last = min(fetched[e] for e in element_ids)
+        return datetime.strptime(last[:19], '%Y-%m-%dT%H:%M:%S')
+
+    def update_fetched(self, latest):
+        '''Register downloaded data, given as a dict with the latest
+        referenceTime per element.'''
+        fetched = self._state['fetched']
+        for element_id, t in latest.items():
+            if t > fetched.get(element_id, ''):
+                fetched[element_id] = t
+
+    def record_fetch(self, start, complete):
+        '''Register a download of data since start, a datetime. complete
+        is false if some of the requests failed. Until the data has been
+        written, write_since goes back to the earliest such start.'''
+        start = datetime.strftime(start, '%Y-%m-%dT%H:%M:%S')
+        pending = self._state.get('pending')
+        if pending is not None:
+            start = min(start, pending['start'])
+        # A later download always starts before anything an earlier one
+        # failed to get, since fetched is only updated by complete ones
+        self._state['pending'] = {'start': start, 'complete': complete}
+
+    def written_until(self, nc_file):
+        '''Get the latest time written to the given netcdf file, in seconds
+        since epoch, or None if it is unknown.'''
+        return self._state['written'].get(os.path.abspath(nc_file))
+
+    def write_since(self, nc_file, lookback):
+        '''Get the time, in seconds since epoch, from which downloaded data
+        should be written to nc_file: lookback (a timedelta) before the
+        previous write, or earlier if data from before that has been
+        downloaded since. None means that everything should be written.'''
+        written = self.written_until(nc_file)
+        if written is None:
+            return None
+        since = written - lookback.total_seconds()
+        pending = self._state.get('pending')
+        if pending is not None:
+            start = datetime.strptime(pending['start'], '%Y-%m-%dT%H:%M:%S')
+            since = min(since, calendar.timegm(start.timetuple()))
+        return since
+
+    def set_written(self, nc_file, seconds):
+        '''Register that data up to seconds since epoch has been written to
+        nc_file. Nothing is registered if the latest download was incomplete,
+        so that the next write includes whatever is downloaded again. Returns
+        whether it was registered.'''
+        pending = self._state.get('pending')
+        if pending is not None and not pending['complete']:
+            return False
+        self._state['written'][os.path.abspath(nc_file)] = seconds
+        self._state.pop('pending', None)
+        return True
+
+    def save(self):
+        folder = os.path.dirname(self._file_name)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        tmp_name = '%s.%d.tmp' % (self._file_name, os.getpid())
+        with open(tmp_name, 'w') as f:
+            json.dump(self._state, f, indent=1, sort_keys=True)
+        os.replace(tmp_name, self._file_name)
@@ -0,0 +1,28 @@
+import dateutil.parser
+from datetime import datetime, timezone
+import numpy
+
+_epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def parse_reference_times(reference_times):
+    '''Convert a list of frost referenceTime strings to an array of seconds
+    since epoch. Frost's own UTC format (2018-03-01T00:00:00.000Z) is parsed
+    in one numpy call, and other strings are left to dateutil.'''
+    try:
+        if all(t.endswith('Z') for t in reference_times):
+            stamps = numpy.array([t[:-1] for t in reference_times], dtype='datetime64[us]')
+            return stamps.astype('int64') / 1e6
+    except ValueError:
+        pass
+    return numpy.array([parse_reference_time(t) for t in reference_times], dtype='f8')
+
+
+def parse_reference_time(reference_time):
+    '''Convert a single referenceTime string to seconds since epoch.'''
+    if reference_time.endswith('Z'):
+        try:
+            return numpy.datetime64(reference_time[:-1], 'us').astype('int64') / 1e6
+        except ValueError:
+            pass
+    return (dateutil.parser.parse(reference_time) - _epoch).total_seconds()
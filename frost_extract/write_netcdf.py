@@ -1,89 +1,123 @@
 import click
-import dateutil.parser
 from datetime import datetime, timezone
 import json
 import logging
 import netCDF4
+import numpy
 import os
 import sys
 import cf_units
 import yaml
 import pkgutil
+from frost_extract.catalogue import ElementLookup, is_catalogue
+from frost_extract.metrics import metrics
+from frost_extract.profiles import collection_layouts, storage_profiles
+from frost_extract.selection import SelectionRules
+from frost_extract.store import ObservationStore
+from frost_extract.times import parse_reference_times
 
 class NetcdfWriter(object):
-    def __init__(self):
-        self._observations = {}
+    def __init__(self, storage_profile='default', selection_rules=None):
+        '''storage_profile is the name of an entry in storage_profiles, used
+        for creating new variables. selection_rules is a SelectionRules
+        object, deciding which observations to use.'''
+        self._observations = ObservationStore()
         self._unit_conversions = {}
+        self._storage = storage_profiles[storage_profile]
+        self._rules = selection_rules or SelectionRules()
 
     def get_obs_name(self, obs):
-        obs_name = obs['elementId'].replace('(', '_').replace(')', '_').replace(' ', '_').strip('_')
-        if 'level' in obs:
-            lvl = obs['level']
-            obs_name += '_%d%s' % (lvl['value'], lvl['unit'])
-        return obs_name
+        return self._rules.compile(obs)[0]
 
     def select_obs(self, timestep):
-        ret = []
-        params = {}
-        for obs in timestep['observations']:
-            instances = params.setdefault(self.get_obs_name(obs), [])
-            instances.append(obs)
-        found_all = True
-        for name, observations in params.items():
-            if len(observations) > 1:
-                selected = self._select_obs(observations)
-                if selected:
-                    ret.append(selected)
-                else:
-                    found_all = False
-            else:
-                ret.append(observations[0])
-        if not found_all:
-           logging.warning('Failed to find suitable candidates for at least some ' + name)
-
-        return ret
-
-    def _select_obs(self, candidates):
-        selected = [ o for o in candidates if o.get('timeOffset', 'PT00H') == 'PT00H' ]
-        if not selected:
-            return None
-        elif len(selected) == 1:
-            return selected[0]
-        return self._get_best_time_resolution(selected)
-
-    def _get_best_time_resolution(self, candidates):
-        selected = [ o for o in candidates if o.get('timeResolution', 'PT1H') == 'PT1H' ]
-        if len(selected) > 1:
-            return None
-        return selected[0]
+        return [obs for name, obs in self._rules.select(timestep['observations'])]
 
     def add_observations(self, obs_files):
-        epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+        '''Add observations from the given files, either json files as
+        downloaded from frost, or npz files as written by save_observations.'''
         for f in obs_files:
-            with open(f) as j:
-                data = json.loads(j.read()) or []
-            for timestep in data:
-                reference_time = dateutil.parser.parse(timestep['referenceTime'])
-                seconds = (reference_time - epoch).total_seconds()
-
-                ts = self._observations.setdefault(seconds, {})
-
-                for obs in self.select_obs(timestep):
-                    data_key = self.get_obs_name(obs)
-
-                    if data_key in ts:
-                        logging.warning(data_key + ' already exists in ' + timestep['referenceTime'])
-                    ts[data_key] = obs
-
-    def write(self, file_name, sources_file, elements_file, append=False):
+            metrics.count('files_read')
+            if f.endswith('.npz'):
+                with metrics.timer('read'):
+                    self._check_selection(f, self._observations.add_file(f))
+                continue
+            with metrics.timer('read'):
+                with open(f) as j:
+                    data = json.loads(j.read()) or []
+            self.add_observation_data(data)
+
+    def add_observation_data(self, data):
+        '''Add a list of observations, as returned from frost'''
+        count = 0
+        with metrics.timer('selection'):
+            times = parse_reference_times([timestep['referenceTime'] for timestep in data])
+            for timestep, seconds in zip(data, times.tolist()):
+                row = self._observations.add_time(seconds)
+                observations = timestep['observations']
+                count += len(observations)
+                for name, obs in self._rules.select(observations):
+                    self._observations.set_value(row, name, obs['elementId'], obs['value'])
+        metrics.count('observations_read', count)
+
+    def save_observations(self, file_name, merge_file=None, replace=None):
+        '''Write the added observations to a compact npz file. If merge_file
+        is given, observations in it are kept, except those within the
+        replace time range, given as a pair of datetimes.'''
+        observations = self._observations
+        if merge_file is not None:
+            epoch = datetime(1970, 1, 1)
+            observations = ObservationStore()
+            self._check_selection(merge_file, observations.add_file(merge_file, tuple((t - epoch).total_seconds() for t in replace)))
+            times, variables = self._observations.timeseries()
+            observations.extend(times, variables, {n: self._observations.element_id(n) for n in variables})
+        observations.save(file_name, self._selection())
+
+    def _selection(self):
+        return {'time_offsets': self._rules.time_offsets, 'time_resolutions': self._rules.time_resolutions}
+
+    def _check_selection(self, file_name, selection):
+        '''npz files only have the observations chosen by the selection rules
+        they were written with, so they cannot be used with other rules'''
+        # Files from older versions were always written with the defaults
+        default = SelectionRules()
+        offsets = selection.get('time_offsets', default.time_offsets)
+        resolutions = selection.get('time_resolutions', default.time_resolutions)
+        if [offsets, resolutions] != [self._rules.time_offsets, self._rules.time_resolutions]:
+            raise RuntimeError('%s was written with time offsets %s and time resolutions %s, not the ones asked for. Use the same --time-offset and --time-resolution options, or convert it again from json'
+                               % (file_name, ', '.join(offsets), ', '.join(resolutions)))
+
+    def last_time(self):
+        '''Get the latest time of all added observations, or None'''
+        return self._observations.last_time()
+
+    def timeseries(self, since=None):
+        '''Get the added observations as a sorted array of times, and a dict
+        of value arrays by variable name, in frost units.'''
+        return self._observations.timeseries(since)
+
+    def element_id(self, name):
+        '''Get the frost element id of a variable'''
+        return self._observations.element_id(name)
+
+    def write(self, file_name, sources_file, elements_file, append=False, since=None):
         with open(sources_file) as f:
             source = json.load(f)
+        elements = load_elements(elements_file)
+        self.write_to(file_name, source, elements, append, since)
 
+    def write_to(self, file_name, source, elements, append=False, since=None):
+        '''Like write, but with the frost source information and a dict of
+        frost elements by id given directly, instead of as file names.'''
         if not file_name:
             if 'wigosId' not in source:
                 raise RuntimeError('Unable to generate output file name')
             file_name = source['wigosId'] + '.nc'
 
+        with metrics.timer('write'):
+            self._write_to(file_name, source, elements, append, since)
+        metrics.count('files_written')
+
+    def _write_to(self, file_name, source, elements, append, since):
         logging.info('Generating ' + file_name)
     
         mode = 'w'
@@ -93,48 +127,41 @@ class NetcdfWriter(object):
 
         logging.debug('Opened file')
 
-        elements = {}
-        with open(elements_file) as f:
-            for e in json.load(f):
-                elements[e['id']] = e
-
         if not append:
             self._add_time_variable(nc)
             self._add_location(nc, source)
             logging.debug('added time and location')
 
 
-        time_indexes = {}
-        times = nc.variables['time']
-        idx = 0
-        for t in times:
-            # print(float(t), dir(t))
-            time_indexes[float(t)] = idx
-            idx += 1
-
-        new_times = list(self._observations.keys())
-        new_times.sort()
-
-
-        for t in new_times:
-            if t not in time_indexes:
-                times[idx] = t
-                time_indexes[t] = idx
-                idx += 1
-
-        logging.debug('times updated')
-
-        for t in new_times:
-            params = self._observations[t]
-            for p, value in params.items():
-                element = elements.get(value['elementId'], {})
-                var = self._get_variable(nc, p, element)
-                convert = self._get_conversion(nc, p, element)
-                idx = time_indexes[t]
-                var[idx] = convert(value['value'])
+        new_times, variables = self._observations.timeseries(since)
+        with metrics.timer('netcdf'):
+            time_indexes, out_of_order = _merge_times(nc.variables['time'], new_times)
+        logging.debug('times updated (%d time steps)' % (len(new_times),))
+
+        for p, values in variables.items():
+            present = ~numpy.isnan(values)
+            if not present.any():
+                continue
+            element = elements.get(self._observations.element_id(p), {})
+            is_new = p not in nc.variables
+            var = self._get_variable(nc, p, element)
+            convert = self._get_conversion(nc, p, element)
+            with metrics.timer('conversion'):
+                converted = convert(values[present])
+            with metrics.timer('netcdf'):
+                _write_column(var, time_indexes[present], converted, is_new)
+            metrics.count('values_written', len(converted))
         logging.debug('added new data')
 
-        self._add_metadata(nc, source)
+        if out_of_order:
+            logging.info('Sorting time axis of ' + file_name)
+            nc.close()
+            with metrics.timer('compact'):
+                compact(file_name)
+            nc = netCDF4.Dataset(file_name, 'a')
+
+        with metrics.timer('metadata'):
+            self._add_metadata(nc, source)
         logging.debug('added metadata')
 
         nc.close()
@@ -142,46 +169,19 @@ class NetcdfWriter(object):
     def _get_variable(self, nc, name, element_information):
         if name not in nc.variables:
             logging.debug('Adding variable: ' + name)
-            var = nc.createVariable(name, 'f4', ('time',), zlib=True)
-            var.long_name = element_information.get('name', name)
-            var.coverage_content_type = 'coordinate'
-            if 'cfConvention' in element_information:
-                cf = element_information['cfConvention']
-                var.standard_name = cf.get('standardName', name)
-                var.units = cf.get('unit', '1')
-                if 'cellMethod' in cf:
-                    var.cell_methods = cf['cellMethod']
-            else:
-                var.standard_name = name
-                var.units = element_information.get('unit', '1')
+            var = nc.createVariable(name, 'f4', ('time',), **self._storage['data'])
+            _set_variable_attributes(var, name, element_information)
             return var
         else:
             return nc.variables[name]
 
     def _get_conversion(self, nc, variable_name, element_information):
         if not variable_name in self._unit_conversions:
-            from_unit = element_information.get('unit', '1')
-            to_unit = from_unit
-            if 'cfConvention' in element_information:
-                cf = element_information['cfConvention']
-                to_unit = cf.get('unit', '1')
-            if from_unit == to_unit:
-                logging.debug('Simple conversion for variable ' + variable_name)
-                self._unit_conversions[variable_name] = lambda x: x
-            else:
-                logging.debug('Converting %s -> %s for variable %s' % (from_unit, to_unit, variable_name))
-                self._unit_conversions[variable_name] = get_conversion_function(from_unit, to_unit)
+            self._unit_conversions[variable_name] = _element_conversion(variable_name, element_information)
         return self._unit_conversions[variable_name]
 
     def _add_time_variable(self, nc):
-        nc.createDimension('time', None)
-        time = nc.createVariable('time', 'double', ('time',), zlib=True)
-        time.standard_name = 'time'
-        time.long_name     = 'Time of measurement'
-        time.calendar      = 'standard'
-        time.units         = 'seconds since 1970-01-01 00:00:00 UTC'
-        time.axis          = 'T'
-        return time
+        return _add_time_variable(nc, 'time', self._storage['time'])
     
     def _add_metadata(self, nc, source):
         source['now'] = datetime.now(tz=timezone.utc).isoformat()
@@ -193,11 +193,11 @@ class NetcdfWriter(object):
         if 'wigosId' not in source:
             source['wigosId'] = 'unknown'
         times = nc.variables['time']
-        source['time_start'] = datetime.fromtimestamp(times[0]).isoformat()
-        source['time_end'] = datetime.fromtimestamp(times[-1]).isoformat()
+        source['time_start'] = datetime.fromtimestamp(float(times[0])).isoformat()
+        source['time_end'] = datetime.fromtimestamp(float(times[-1])).isoformat()
 
         config = pkgutil.get_data('frost_extract', 'templates/global_attributes.yaml')
-        for entry in yaml.load(config):
+        for entry in yaml.safe_load(config):
             for key, raw in entry.items():
                 value = raw % source
                 setattr(nc, key, value)
@@ -224,10 +224,503 @@ class NetcdfWriter(object):
         for i in range(len(station_id)):
             station_id[i] = station_name[i]
 
+class CollectionWriter(object):
+    '''Writes observations from many stations to a single CF-1.6 timeSeries
+    collection file, with a station dimension.
+
+    In the orthogonal layout, all stations share the time axis, and data
+    variables have dimensions (station, time). New stations and time steps
+    are added to an existing file in place. In the contiguous ragged layout,
+    each station only has its own time steps, stored one station after the
+    other along an obs dimension, with row_size telling how many belong to
+    each station. That is more compact when stations cover different
+    periods, but appending means rewriting the whole file.'''
+
+    # Length of the character dimension for station names and ids
+    name_length = 64
+
+    def __init__(self, layout='orthogonal', storage_profile='default', selection_rules=None):
+        if layout not in collection_layouts:
+            raise RuntimeError('Unknown layout %s. Use one of %s' % (layout, ', '.join(collection_layouts)))
+        self._layout = layout
+        self._storage_profile = storage_profile
+        self._storage = storage_profiles[storage_profile]
+        self._rules = selection_rules or SelectionRules()
+        self._stations = {}
+        self._unit_conversions = {}
+
+    def add_station(self, source, obs_files=()):
+        '''Add a station, given its frost source information, along with
+        observations from json or npz files written by download
+        observations.'''
+        self._writer(source).add_observations(obs_files)
+
+    def add_station_data(self, source, data):
+        '''Add a list of observations for a station, as returned from frost'''
+        self._writer(source).add_observation_data(data)
+
+    def _writer(self, source):
+        station = source['id']
+        if station not in self._stations:
+            self._stations[station] = source, NetcdfWriter(self._storage_profile, self._rules)
+        return self._stations[station][1]
+
+    def write(self, file_name, elements_file, append=False):
+        self.write_to(file_name, load_elements(elements_file), append)
+
+    def write_to(self, file_name, elements, append=False):
+        '''Like write, but with a dict of frost elements by id given
+        directly, instead of as a file name.'''
+        logging.info('Generating %s for %d stations' % (file_name, len(self._stations)))
+        with metrics.timer('write'):
+            if self._layout == 'orthogonal':
+                self._write_orthogonal(file_name, elements, append)
+            else:
+                self._write_ragged(file_name, elements, append)
+        metrics.count('files_written')
+
+    def _write_orthogonal(self, file_name, elements, append):
+        nc = netCDF4.Dataset(file_name, 'a' if append else 'w', format='NETCDF4')
+        if not append:
+            self._add_station_variables(nc)
+            _add_time_variable(nc, 'time', self._storage['time'])
+        rows = self._station_rows(nc)
+
+        series = {station: writer.timeseries() for station, (source, writer) in self._stations.items()}
+        all_times = numpy.unique(numpy.concatenate([times for times, variables in series.values()] + [numpy.empty(0)]))
+        with metrics.timer('netcdf'):
+            time_indexes, out_of_order = _merge_times(nc.variables['time'], all_times)
+        logging.debug('times updated (%d time steps)' % (len(all_times),))
+
+        for station, (times, variables) in series.items():
+            row = rows[station]
+            indexes = time_indexes[numpy.searchsorted(all_times, times)]
+            writer = self._stations[station][1]
+            for name, values in variables.items():
+                present = ~numpy.isnan(values)
+                if not present.any():
+                    continue
+                element = elements.get(writer.element_id(name), {})
+                var = self._get_variable(nc, name, element, ('station', 'time'))
+                is_new = row >= var.shape[0]
+                with metrics.timer('conversion'):
+                    converted = self._get_conversion(name, element)(values[present])
+                with metrics.timer('netcdf'):
+                    _write_column(var, indexes[present], converted, is_new, row)
+                metrics.count('values_written', len(converted))
+        logging.debug('added new data')
+
+        if out_of_order:
+            logging.info('Sorting time axis of ' + file_name)
+            nc.close()
+            with metrics.timer('compact'):
+                compact(file_name)
+            nc = netCDF4.Dataset(file_name, 'a')
+
+        with metrics.timer('metadata'):
+            self._add_metadata(nc, 'orthogonal')
+        nc.close()
+
+    def _write_ragged(self, file_name, elements, append):
+        # Each station's observations must be kept together, so the file is
+        # always written anew, after reading back the stations already in it
+        stations = {}
+        attributes = {}
+        if append and os.path.exists(file_name):
+            stations, attributes = _read_ragged(file_name)
+        variable_elements = {name: {} for name in attributes}
+
+        for station, (source, writer) in self._stations.items():
+            new_times, variables = writer.timeseries()
+            info, times, values = stations.get(station, (None, numpy.empty(0), {}))
+            all_times = numpy.union1d(times, new_times)
+            old_indexes = numpy.searchsorted(all_times, times)
+            new_indexes = numpy.searchsorted(all_times, new_times)
+            merged = {}
+            for name, v in values.items():
+                merged[name] = numpy.full(len(all_times), numpy.nan, dtype='f4')
+                merged[name][old_indexes] = v
+            for name, v in variables.items():
+                present = ~numpy.isnan(v)
+                if not present.any():
+                    continue
+                element = elements.get(writer.element_id(name), {})
+                variable_elements.setdefault(name, element)
+                if name not in merged:
+                    merged[name] = numpy.full(len(all_times), numpy.nan, dtype='f4')
+                with metrics.timer('conversion'):
+                    merged[name][new_indexes[present]] = self._get_conversion(name, element)(v[present])
+                metrics.count('values_written', numpy.count_nonzero(present))
+            stations[station] = _station_info(source), all_times, merged
+
+        tmp_name = '%s.%d.tmp' % (file_name, os.getpid())
+        with netCDF4.Dataset(tmp_name, 'w', format='NETCDF4') as nc:
+            self._add_station_variables(nc)
+            row_size = nc.createVariable('row_size', 'i4', ('station',))
+            row_size.long_name = 'number of observations for this station'
+            row_size.sample_dimension = 'obs'
+            time = _add_time_variable(nc, 'obs', self._storage['time'])
+
+            with metrics.timer('netcdf'):
+                for row, (station, (info, times, values)) in enumerate(stations.items()):
+                    self._set_station(nc, row, info)
+                    row_size[row] = len(times)
+                offsets = numpy.cumsum([0] + [len(times) for info, times, values in stations.values()])
+                time[:] = numpy.concatenate([times for info, times, values in stations.values()] + [numpy.empty(0)])
+                for name, element in variable_elements.items():
+                    var = self._get_variable(nc, name, element, ('obs',))
+                    if name in attributes:
+                        var.setncatts(attributes[name])
+                    fill_value = var._FillValue if '_FillValue' in var.ncattrs() else netCDF4.default_fillvals['f4']
+                    data = numpy.full(offsets[-1], fill_value, dtype='f4')
+                    for (info, times, values), offset in zip(stations.values(), offsets):
+                        if name in values:
+                            v = values[name]
+                            data[offset:offset + len(v)] = numpy.where(numpy.isnan(v), fill_value, v)
+                    var[:] = data
+
+            with metrics.timer('metadata'):
+                self._add_metadata(nc, 'contiguous ragged')
+        os.replace(tmp_name, file_name)
+
+    def _add_station_variables(self, nc):
+        nc.createDimension('station', None)
+        nc.createDimension('name_strlen', self.name_length)
+
+        station_id = nc.createVariable('station_id', 'S1', ('station', 'name_strlen'))
+        station_id.long_name = 'station id'
+        station_id.cf_role = 'timeseries_id'
+
+        station_name = nc.createVariable('station_name', 'S1', ('station', 'name_strlen'))
+        station_name.long_name = 'station name'
+
+        wigos = nc.createVariable('wigos_identifier', 'S1', ('station', 'name_strlen'))
+        wigos.long_name = 'WIGOS station identifier'
+
+        lat = nc.createVariable('latitude', 'float', ('station',))
+        lat.standard_name = 'latitude'
+        lat.long_name     = 'latitude'
+        lat.units         = 'degree_north'
+
+        lon = nc.createVariable('longitude', 'float', ('station',))
+        lon.standard_name = 'longitude'
+        lon.long_name     = 'longitude'
+        lon.units         = 'degree_east'
+
+    def _station_rows(self, nc):
+        '''Get the row of each added station, adding new stations to the
+        end of the station dimension.'''
+        ids = [str(s) for s in netCDF4.chartostring(nc.variables['station_id'][:])]
+        rows = {station: row for row, station in enumerate(ids)}
+        for station, (source, writer) in self._stations.items():
+            if station not in rows:
+                rows[station] = len(rows)
+                self._set_station(nc, rows[station], _station_info(source))
+        return rows
+
+    def _set_station(self, nc, row, info):
+        for name in ('station_id', 'station_name', 'wigos_identifier'):
+            value = info[name].encode('utf8')[:self.name_length].ljust(self.name_length, b'\0')
+            nc.variables[name][row] = numpy.frombuffer(value, dtype='S1')
+        nc.variables['latitude'][row] = info['latitude']
+        nc.variables['longitude'][row] = info['longitude']
+
+    def _get_variable(self, nc, name, element_information, dimensions):
+        if name in nc.variables:
+            return nc.variables[name]
+        logging.debug('Adding variable: ' + name)
+        settings = dict(self._storage['data'])
+        if len(dimensions) == 2:
+            # One station's series is written at a time, so chunks should
+            # only span a single station
+            settings['chunksizes'] = (1,) + settings.get('chunksizes', (4096,))
+        var = nc.createVariable(name, 'f4', dimensions, **settings)
+        _set_variable_attributes(var, name, element_information)
+        var.coordinates = 'time latitude longitude station_id'
+        return var
+
+    def _get_conversion(self, variable_name, element_information):
+        if not variable_name in self._unit_conversions:
+            self._unit_conversions[variable_name] = _element_conversion(variable_name, element_information)
+        return self._unit_conversions[variable_name]
+
+    def _add_metadata(self, nc, layout):
+        latitudes = numpy.ma.compressed(nc.variables['latitude'][:])
+        longitudes = numpy.ma.compressed(nc.variables['longitude'][:])
+        times = numpy.ma.compressed(nc.variables['time'][:])
+        values = {
+            'now': datetime.now(tz=timezone.utc).isoformat(),
+            'program_args': 'frost write collection',
+            'layout': layout,
+            'station_count': len(latitudes),
+            'latitude_min': latitudes.min(initial=90),
+            'latitude_max': latitudes.max(initial=-90),
+            'longitude_min': longitudes.min(initial=180),
+            'longitude_max': longitudes.max(initial=-180),
+            'time_start': datetime.fromtimestamp(float(times.min()), tz=timezone.utc).isoformat() if len(times) else '',
+            'time_end': datetime.fromtimestamp(float(times.max()), tz=timezone.utc).isoformat() if len(times) else '',
+        }
+        config = pkgutil.get_data('frost_extract', 'templates/collection_attributes.yaml')
+        for entry in yaml.safe_load(config):
+            for key, raw in entry.items():
+                setattr(nc, key, raw % values)
+
+def _station_info(source):
+    longitude, latitude = source['geometry']['coordinates'][:2]
+    return {
+        'station_id': source['id'],
+        'station_name': source.get('name', source['id']),
+        'wigos_identifier': source.get('wigosId', 'unknown'),
+        'latitude': latitude,
+        'longitude': longitude,
+    }
+
+def _read_ragged(file_name):
+    '''Read back a file written by CollectionWriter in the ragged layout.
+    Returns a dict of (station info, times, {name: values}) by station, and
+    a dict of data variable attributes by name.'''
+    stations = {}
+    attributes = {}
+    with netCDF4.Dataset(file_name) as nc:
+        info = {}
+        for name in ('station_id', 'station_name', 'wigos_identifier'):
+            info[name] = [str(s) for s in netCDF4.chartostring(nc.variables[name][:])]
+        for name in ('latitude', 'longitude'):
+            info[name] = numpy.ma.getdata(nc.variables[name][:]).tolist()
+        row_size = numpy.ma.getdata(nc.variables['row_size'][:])
+        offsets = numpy.cumsum(numpy.concatenate([[0], row_size]))
+        times = numpy.ma.getdata(nc.variables['time'][:])
+
+        data = {}
+        for name, var in nc.variables.items():
+            if var.dimensions == ('obs',) and name != 'time':
+                attributes[name] = {a: var.getncattr(a) for a in var.ncattrs() if a != '_FillValue'}
+                data[name] = numpy.ma.filled(var[:].astype('f4'), numpy.nan)
+
+        for row, station in enumerate(info['station_id']):
+            rows = slice(offsets[row], offsets[row + 1])
+            station_info = {name: info[name][row] for name in info}
+            values = {name: v[rows] for name, v in data.items() if not numpy.isnan(v[rows]).all()}
+            stations[station] = station_info, times[rows], values
+    return stations, attributes
+
+def _set_variable_attributes(var, name, element_information):
+    var.long_name = element_information.get('name', name)
+    var.coverage_content_type = 'coordinate'
+    if 'cfConvention' in element_information:
+        cf = element_information['cfConvention']
+        var.standard_name = cf.get('standardName', name)
+        var.units = cf.get('unit', '1')
+        if 'cellMethod' in cf:
+            var.cell_methods = cf['cellMethod']
+    else:
+        var.standard_name = name
+        var.units = element_information.get('unit', '1')
+
+# Set on the time variable while its values are out of order, until compact
+# has sorted them
+_unsorted_attribute = 'frost_extract_unsorted'
+
+def _merge_times(times, new_times):
+    '''Add the sorted new_times that are not already in the time
+    variable to its end. Returns the index of each new time, and whether
+    the time variable is now out of order. The time variable is taken to be
+    sorted, as compact leaves it, unless it is marked as unsorted, so only
+    the end of it that new_times overlaps is read.'''
+    size = times.shape[0]
+    if not len(new_times):
+        return numpy.empty(0, dtype=int), False
+    if size == 0 or new_times[0] > times[size - 1]:
+        times[size:size + len(new_times)] = new_times
+        return numpy.arange(size, size + len(new_times)), False
+
+    unsorted = _unsorted_attribute in times.ncattrs()
+    start = 0 if unsorted else _tail_start(times, size, new_times[0])
+    existing = numpy.ma.getdata(times[start:size])
+    order = numpy.argsort(existing, kind='stable')
+    sorted_times = existing[order]
+    # side='right' picks the last of any duplicated times, as before
+    pos = numpy.searchsorted(sorted_times, new_times, side='right') - 1
+    found = pos >= 0
+    found[found] = sorted_times[pos[found]] == new_times[found]
+
+    indexes = numpy.empty(len(new_times), dtype=int)
+    indexes[found] = start + order[pos[found]]
+    missing = ~found
+    added = numpy.count_nonzero(missing)
+    indexes[missing] = numpy.arange(size, size + added)
+    out_of_order = unsorted
+    if added:
+        times[size:size + added] = new_times[missing]
+        out_of_order = out_of_order or new_times[missing][0] < sorted_times[-1]
+    if out_of_order and not unsorted:
+        times.setncattr(_unsorted_attribute, 1)
+    return indexes, out_of_order
+
+def _tail_start(times, size, value, block=1024):
+    '''Find an index in the sorted time variable with a time before value,
+    or 0, reading single values at growing distances from the end'''
+    start = size
+    while start > 0:
+        start = max(0, size - block)
+        if times[start] < value:
+            break
+        block *= 4
+    return start
+
+def _write_column(var, indexes, values, is_new, row=None):
+    '''Write all values for a variable in one slice assignment. Time
+    steps inside the slice that are not given keep their old value, or
+    get the fill value if there is none. For variables with dimensions
+    (station, time), row is the station to write.'''
+    start = indexes.min()
+    stop = indexes.max() + 1
+    fill_value = getattr(var, '_FillValue', netCDF4.default_fillvals[var.dtype.str[1:]])
+    data = numpy.full(stop - start, fill_value, dtype=var.dtype)
+    key = lambda a, b: slice(a, b) if row is None else (row, slice(a, b))
+    if not is_new:
+        existing = min(stop, var.shape[-1])
+        if existing > start:
+            data[:existing - start] = numpy.ma.filled(var[key(start, existing)], fill_value)
+    data[indexes - start] = values
+    var[key(start, stop)] = data
+
+def _add_time_variable(nc, dimension, settings):
+    nc.createDimension(dimension, None)
+    time = nc.createVariable('time', 'double', (dimension,), **settings)
+    time.standard_name = 'time'
+    time.long_name     = 'Time of measurement'
+    time.calendar      = 'standard'
+    time.units         = 'seconds since 1970-01-01 00:00:00 UTC'
+    time.axis          = 'T'
+    return time
+
+def _element_conversion(variable_name, element_information):
+    '''Get a function converting values from the frost unit of an element
+    to its CF unit'''
+    from_unit = element_information.get('unit', '1')
+    to_unit = from_unit
+    if 'cfConvention' in element_information:
+        cf = element_information['cfConvention']
+        to_unit = cf.get('unit', '1')
+    if from_unit == to_unit:
+        logging.debug('Simple conversion for variable ' + variable_name)
+        return lambda x: x
+    logging.debug('Converting %s -> %s for variable %s' % (from_unit, to_unit, variable_name))
+    return get_conversion_function(from_unit, to_unit)
+
+def compact(file_name, chunk_size=65536):
+    '''Sort the time axis of a netcdf file, along with all variables that
+    use it. The file is copied chunk_size time steps at a time to a new file,
+    which then replaces the original. Returns False if the file was already
+    sorted.'''
+    with netCDF4.Dataset(file_name) as src:
+        times = numpy.ma.getdata(src.variables['time'][:])
+        marked = _unsorted_attribute in src.variables['time'].ncattrs()
+    if not numpy.any(times[1:] < times[:-1]):
+        if marked:
+            with netCDF4.Dataset(file_name, 'a') as nc:
+                nc.variables['time'].delncattr(_unsorted_attribute)
+        return False
+    order = numpy.argsort(times, kind='stable')
+
+    with netCDF4.Dataset(file_name) as src:
+        tmp_name = '%s.%d.tmp' % (file_name, os.getpid())
+        with netCDF4.Dataset(tmp_name, 'w', format=src.data_model) as dst:
+            dst.setncatts({a: src.getncattr(a) for a in src.ncattrs()})
+            for name, dimension in src.dimensions.items():
+                dst.createDimension(name, None if dimension.isunlimited() else len(dimension))
+            for name, var in src.variables.items():
+                out = _copy_variable_definition(dst, var)
+                # Explicit bounds, since other dimensions may be unlimited too
+                whole = [slice(0, n) for n in var.shape]
+                if 'time' not in var.dimensions:
+                    if var.ndim:
+                        out[tuple(whole)] = var[...]
+                    else:
+                        out[...] = var[...]
+                    continue
+                axis = var.dimensions.index('time')
+                for start in range(0, len(order), chunk_size):
+                    stop = min(start + chunk_size, len(order))
+                    key = list(whole)
+                    key[axis] = slice(start, stop)
+                    out[tuple(key)] = _read_time_steps(var, axis, order[start:stop])
+    os.replace(tmp_name, file_name)
+    return True
+
+def _copy_variable_definition(dst, var):
+    settings = {}
+    filters = var.filters() or {}
+    for key in ('zlib', 'complevel', 'shuffle', 'fletcher32'):
+        if key in filters:
+            settings[key] = filters[key]
+    chunking = var.chunking()
+    if chunking == 'contiguous':
+        settings['contiguous'] = True
+    elif chunking:
+        settings['chunksizes'] = chunking
+    attributes = {a: var.getncattr(a) for a in var.ncattrs() if a != _unsorted_attribute}
+    if '_FillValue' in attributes:
+        settings['fill_value'] = attributes.pop('_FillValue')
+    ret = dst.createVariable(var.name, var.datatype, var.dimensions, **settings)
+    ret.setncatts(attributes)
+    return ret
+
+def _read_time_steps(var, axis, indexes):
+    '''Read the given, unsorted, time steps from var'''
+    # netCDF4 wants sorted indexes, and reading a slice is fastest when the
+    # indexes are close together, as they are in a mostly sorted file
+    permutation = numpy.argsort(indexes)
+    sorted_indexes = indexes[permutation]
+    first = sorted_indexes[0]
+    span = sorted_indexes[-1] - first + 1
+    key = [slice(None)] * var.ndim
+    if span <= 4 * len(indexes):
+        key[axis] = slice(first, first + span)
+        data = numpy.ma.take(var[tuple(key)], sorted_indexes - first, axis=axis)
+    else:
+        key[axis] = sorted_indexes
+        data = var[tuple(key)]
+    return numpy.ma.take(data, numpy.argsort(permutation), axis=axis)
+
+def load_elements(elements_file):
+    '''Read a file with frost elements information, returning a dict of
+    elements by id. The file may also be a catalogue, as written by
+    --catalogue, in which case elements are only read when looked up.'''
+    if is_catalogue(elements_file):
+        return ElementLookup(elements_file)
+    elements = {}
+    with open(elements_file) as f:
+        for e in json.load(f):
+            elements[e['id']] = e
+    return elements
+
+_conversion_functions = {}
+
 def get_conversion_function(unit_from, unit_to):
+    '''Get a function that converts an array of values between the given
+    units. Functions are shared between all writers in the process.'''
+    key = (unit_from, unit_to)
+    if key not in _conversion_functions:
+        _conversion_functions[key] = _create_conversion_function(unit_from, unit_to)
+    return _conversion_functions[key]
+
+def _create_conversion_function(unit_from, unit_to):
     f = cf_units.Unit(unit_from)
     t = cf_units.Unit(unit_to)
     if not f.is_convertible(t):
         logging.warning('Units are not convertible: %s -> %s' % (unit_from, unit_to))
         return lambda x: x
-    return lambda x: f.convert(x, t)
+
+    # Most conversions are affine, so try to reduce them to a multiply-add
+    probe = numpy.array([0.0, 1000.0, 1.0, -273.15])
+    converted = f.convert(probe, t)
+    offset = converted[0]
+    scale = (converted[1] - offset) / 1000.0
+    # Some probes, such as -273.15 degC, convert to zero, so the tolerance
+    # is also scaled by the offset that is added to every value
+    if numpy.allclose(probe * scale + offset, converted, rtol=1e-12, atol=1e-9 * max(1, abs(offset))):
+        return lambda x: numpy.asarray(x, dtype='f8') * scale + offset
+    logging.debug('Conversion %s -> %s is not affine' % (unit_from, unit_to))
+    return lambda x: f.convert(numpy.asarray(x, dtype='f8'), t)
@@ -7,6 +7,7 @@ setup(
     install_requires=[
         'Click',
         'netCDF4',
+        'numpy',
         'python-dateutil',
         'cf_units',
         'jinja2',
@@ -15,7 +16,7 @@ setup(
     packages=['frost_extract'],
     package_dir={'frost_extract': 'frost_extract'},
     package_data={
-        'frost_extract': ['templates/mmd.xml', 'templates/global_attributes.yaml']
+        'frost_extract': ['templates/mmd.xml', 'templates/global_attributes.yaml', 'templates/collection_attributes.yaml']
         },
     entry_points='''
         [console_scripts]
@@ -0,0 +1,18 @@
+from datetime import datetime, timedelta
+import os
+from frost_extract.read_frost import save_batch
+from frost_extract.sync_state import SyncState
+from test_sync import FakeFrost
+
+
+def test_batch_starts_from_the_station_furthest_behind(tmp_path):
+    frost = FakeFrost(datetime(2026, 1, 1), datetime(2026, 6, 1))
+    stations = ['SN90000', 'SN90001']
+    sync_states = {s: SyncState(str(tmp_path / s / 'sync_state.json')) for s in stations}
+    sync_states['SN90000'].update_fetched({'air_temperature': '2026-05-20T00:00:00.000Z'})
+    sync_states['SN90001'].update_fetched({'air_temperature': '2026-03-01T00:00:00.000Z'})
+
+    files = save_batch(frost, stations, ['air_temperature'], (datetime(2026, 1, 1), datetime(2026, 6, 1)), str(tmp_path), sync_states=sync_states)
+
+    assert frost.requests[0][0] == datetime(2026, 3, 1) - timedelta(hours=48)
+    assert [os.path.basename(f) for f in files['SN90001']] == ['02.json', '03.json', '04.json', '05.json']
@@ -0,0 +1,69 @@
+from datetime import datetime, timedelta, timezone
+import io
+import urllib.error
+import netCDF4
+import numpy
+from frost_extract.sync import sync
+
+element = {'id': 'air_temperature', 'name': 'Air temperature', 'unit': 'degC',
+           'cfConvention': {'standardName': 'air_temperature', 'unit': 'K'}}
+
+
+class FakeFrost(object):
+    '''Hourly air temperature for any station from start until end, without
+    a server. Requests for periods that overlap failing_month get a 500.
+    The periods asked for are kept in requests.'''
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.failing_month = None
+        self.requests = []
+
+    def get_source(self, station):
+        return {'id': station, 'name': 'TEST', 'wigosId': '0-578-0-90000', 'wmoId': 90000, 'geometry': {'type': 'Point', 'coordinates': [10.0, 59.0]}}
+
+    def get_element_lookup(self):
+        return {element['id']: element}
+
+    def get_available_elements(self, stations, time_range, element_filter):
+        # Minute resolution, so that each month is asked for on its own
+        return [{'sourceId': station + ':0', 'elementId': 'air_temperature', 'validFrom': '2026-01-01T00:00:00.000Z',
+                 'timeOffset': 'PT0H', 'timeResolution': 'PT1M'} for station in stations]
+
+    def get_data(self, stations, elements, time_range):
+        time_from, time_to = time_range
+        self.requests.append(time_range)
+        if self.failing_month is not None and time_from < self.failing_month[1] and self.failing_month[0] < time_to:
+            raise urllib.error.HTTPError('', 500, 'Internal Server Error', {}, io.BytesIO())
+        data = []
+        t = max(time_from, self.start)
+        while t < min(time_to, self.end):
+            for station in stations:
+                data.append({
+                    'sourceId': station + ':0',
+                    'referenceTime': t.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                    'observations': [{'elementId': 'air_temperature', 'value': float(t.day), 'unit': 'degC',
+                                      'timeOffset': 'PT0H', 'timeResolution': 'PT1H'}],
+                })
+            t += timedelta(hours=1)
+        return data
+
+
+def test_month_that_failed_is_written_by_next_sync(tmp_path):
+    time_range = (datetime(2026, 1, 1), datetime(2026, 6, 1))
+    frost = FakeFrost(datetime(2026, 1, 1), datetime(2026, 3, 1))
+    assert sync(frost, ['SN90000'], ['air_temperature'], time_range, str(tmp_path), jobs=1) == []
+
+    # March fails, while April gets written
+    frost.end = datetime(2026, 5, 1)
+    frost.failing_month = (datetime(2026, 3, 1), datetime(2026, 4, 1))
+    sync(frost, ['SN90000'], ['air_temperature'], time_range, str(tmp_path), jobs=1)
+
+    frost.failing_month = None
+    assert sync(frost, ['SN90000'], ['air_temperature'], time_range, str(tmp_path), jobs=1) == []
+
+    with netCDF4.Dataset(str(tmp_path / 'SN90000.nc')) as nc:
+        times = nc.variables['time'][:]
+    expected = numpy.arange(datetime(2026, 1, 1, tzinfo=timezone.utc).timestamp(), datetime(2026, 5, 1, tzinfo=timezone.utc).timestamp(), 3600)
+    numpy.testing.assert_array_equal(times, expected)
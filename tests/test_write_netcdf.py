@@ -0,0 +1,14 @@
+import cf_units
+import logging
+import numpy
+import pytest
+from frost_extract.write_netcdf import _create_conversion_function
+
+
+@pytest.mark.parametrize('unit_from, unit_to', [('degC', 'K'), ('hPa', 'Pa'), ('km/h', 'm/s')])
+def test_common_conversions_are_affine(unit_from, unit_to, caplog):
+    caplog.set_level(logging.DEBUG)
+    convert = _create_conversion_function(unit_from, unit_to)
+    assert 'not affine' not in caplog.text
+    values = numpy.array([-40.0, 0.0, 12.5, 1013.2])
+    numpy.testing.assert_allclose(convert(values), cf_units.Unit(unit_from).convert(values, cf_units.Unit(unit_to)))